@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+"""Run micro- and end-to-end benchmarks on a synthetic collection.
+
+Usage: python3 -m benchmarks [options] [-o results.json]
+"""
+
+import sys
+import tempfile
+
+from . import micro, e2e
+from .common import make_app, write_results, print_results
+from .corpus import add_corpus_arguments, corpus_params, generate_collection
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Run sentanno benchmarks')
+    add_corpus_arguments(ap)
+    ap.set_defaults(documents=20)
+    ap.add_argument('-r', '--repeat', type=int, default=10,
+                    help='repetitions per document (micro-benchmarks)')
+    ap.add_argument('-R', '--e2e-repeat', type=int, default=3,
+                    help='repetitions per URL (end-to-end benchmarks)')
+    ap.add_argument('-s', '--suite', choices=['all', 'micro', 'e2e'],
+                    default='all')
+    ap.add_argument('-o', '--output', default='-',
+                    help='JSON output file (default STDOUT)')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    params = corpus_params(args)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        names = generate_collection(tmpdir, 'synthetic', **params)
+        app = make_app(tmpdir, tmpdir)
+        results = []
+        if args.suite in ('all', 'micro'):
+            results.extend(micro.run(app, 'synthetic', names, args.repeat))
+        if args.suite in ('all', 'e2e'):
+            results.extend(e2e.run(app, 'synthetic', names, args.e2e_repeat))
+    params.update(repeat=args.repeat, e2e_repeat=args.e2e_repeat)
+    print_results(results)
+    write_results(args.output, params, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
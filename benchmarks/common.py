@@ -0,0 +1,95 @@
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+
+from datetime import datetime, timezone
+
+
+def measure(func, setup=None, repeat=20, number=1):
+    """Time func() repeat times, calling setup() before each timing
+    (untimed) and passing its return value to func if not None.
+    Returns per-call times in seconds."""
+    times = []
+    for i in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        for j in range(number):
+            func(*args)
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    idx = min(len(values)-1, int(round(p / 100 * (len(values)-1))))
+    return values[idx]
+
+
+def summarize(name, times, **extra):
+    result = {
+        'name': name,
+        'n': len(times),
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'p95': percentile(times, 95),
+        'max': max(times),
+    }
+    result.update(extra)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def run_metadata(params):
+    return {
+        'time': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'params': params,
+    }
+
+
+def write_results(fn, params, results):
+    data = {
+        'meta': run_metadata(params),
+        'results': results,
+    }
+    if fn == '-':
+        json.dump(data, sys.stdout, indent=2)
+        print()
+    else:
+        with open(fn, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+def make_app(data_dir, temp_dir, **config):
+    """Create app serving data_dir."""
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    from sentanno import create_app
+    app = create_app()
+    app.config['DATADIR'] = data_dir
+    app.config['TEMPDIR'] = temp_dir
+    app.config.update(config)
+    return app
+
+
+def print_results(results, file=sys.stderr):
+    for r in results:
+        print('{:<40} median {:9.3f}ms  p95 {:9.3f}ms  (n={})'.format(
+            r['name'], r['median']*1000, r['p95']*1000, r['n']), file=file)
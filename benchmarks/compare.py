@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+"""Compare two benchmark result files.
+
+Usage: python3 -m benchmarks.compare BASELINE.json NEW.json
+"""
+
+import sys
+import json
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Compare benchmark results')
+    ap.add_argument('-k', '--key', default='median',
+                    choices=['min', 'median', 'mean', 'p95', 'max'])
+    ap.add_argument('baseline')
+    ap.add_argument('new')
+    return ap
+
+
+def load_results(fn):
+    with open(fn) as f:
+        data = json.load(f)
+    return data['meta'], { r['name']: r for r in data['results'] }
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    base_meta, base = load_results(args.baseline)
+    new_meta, new = load_results(args.new)
+    print('{:<40} {:>12} {:>12} {:>8}'.format(
+        args.key, base_meta.get('revision'), new_meta.get('revision'),
+        'change'))
+    for name in base:
+        if name not in new:
+            continue
+        b, n = base[name][args.key], new[name][args.key]
+        change = (n - b) / b * 100 if b else float('nan')
+        print('{:<40} {:>10.3f}ms {:>10.3f}ms {:>+7.1f}%'.format(
+            name, b*1000, n*1000, change))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""Generate synthetic collections in the sentanno data format."""
+
+import sys
+import os
+import json
+import random
+
+
+TYPES = ['ORG', 'PRODUCT', 'PERSON']
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Generate synthetic collection')
+    add_corpus_arguments(ap)
+    ap.add_argument('-c', '--collection', default='synthetic')
+    ap.add_argument('datadir', help='output data directory')
+    return ap
+
+
+def add_corpus_arguments(ap):
+    ap.add_argument('--documents', type=int, default=100,
+                    help='number of documents')
+    ap.add_argument('--text-length', type=int, default=1000,
+                    help='approximate document length in characters')
+    ap.add_argument('--annotations', type=int, default=10,
+                    help='annotations per document')
+    ap.add_argument('--overlap', type=float, default=0.1,
+                    help='fraction of annotations overlapping another')
+    ap.add_argument('--newlines', type=float, default=0.02,
+                    help='probability of newline after word')
+    ap.add_argument('--vocabulary', type=int, default=2000,
+                    help='number of distinct words')
+    ap.add_argument('--seed', type=int, default=1234)
+    return ap
+
+
+def _random_word(rng):
+    length = rng.randint(1, 10)
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyzäö')
+                   for i in range(length))
+
+
+def generate_text(rng, vocabulary, length, newlines):
+    """Return text and list of (start, end) word offsets."""
+    parts, words, offset = [], [], 0
+    while offset < length:
+        word = rng.choice(vocabulary)
+        words.append((offset, offset+len(word)))
+        separator = '\n' if rng.random() < newlines else ' '
+        parts.extend([word, separator])
+        offset += len(word) + 1
+    return ''.join(parts), words
+
+
+def generate_annotations(rng, text, words, count, overlap):
+    """Return standoff lines for count annotations on word boundaries."""
+    spans = []
+    for i in range(min(count, len(words))):
+        if spans and rng.random() < overlap:
+            # extend an earlier span by a word on either side
+            start, end = rng.choice(spans)
+            idx = next(j for j, w in enumerate(words) if w[0] == start)
+            first = max(0, idx - 1)
+            last = min(len(words)-1, idx + rng.randint(1, 3))
+        else:
+            first = rng.randrange(len(words))
+            last = min(len(words)-1, first + rng.randint(0, 2))
+        spans.append((words[first][0], words[last][1]))
+    lines = []
+    for i, (start, end) in enumerate(spans, start=1):
+        lines.append('T{}\t{} {} {}\t{}'.format(
+            i, rng.choice(TYPES), start, end,
+            text[start:end].replace('\n', ' ')))
+    return lines
+
+
+def generate_collection(datadir, collection, documents=100, text_length=1000,
+                        annotations=10, overlap=0.1, newlines=0.02,
+                        vocabulary=2000, seed=1234):
+    """Write synthetic documents into datadir/collection, return the
+    list of document names."""
+    rng = random.Random(seed)
+    words = [_random_word(rng) for i in range(vocabulary)]
+    collection_dir = os.path.join(datadir, collection)
+    os.makedirs(collection_dir, exist_ok=True)
+    names = []
+    for i in range(documents):
+        name = 'doc{:06d}'.format(i)
+        text, offsets = generate_text(rng, words, text_length, newlines)
+        lines = generate_annotations(rng, text, offsets, max(annotations, 1),
+                                     overlap)
+        root = os.path.join(collection_dir, name)
+        with open(root+'.txt', 'w', encoding='utf-8') as f:
+            f.write(text)
+        with open(root+'.ann', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines)+'\n')
+        with open(root+'.json', 'w', encoding='utf-8') as f:
+            json.dump({'candidate_id': 'T1'}, f)
+        names.append(name)
+    return names
+
+
+def corpus_params(args):
+    return {
+        'documents': args.documents,
+        'text_length': args.text_length,
+        'annotations': args.annotations,
+        'overlap': args.overlap,
+        'newlines': args.newlines,
+        'vocabulary': args.vocabulary,
+        'seed': args.seed,
+    }
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    names = generate_collection(args.datadir, args.collection,
+                                **corpus_params(args))
+    print('wrote {} documents to {}'.format(
+        len(names), os.path.join(args.datadir, args.collection)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,23 @@
+"""End-to-end benchmarks driving the app through the Flask test client."""
+
+from .common import measure, summarize
+
+
+def run(app, collection, names, repeat=5):
+    client = app.test_client()
+    results = []
+    def bench(name, urls):
+        times = []
+        for url in urls:
+            def get():
+                response = client.get(url)
+                assert response.status_code == 200, (url, response.status)
+                response.get_data()    # streamed pages render here
+            times.extend(measure(get, repeat=repeat))
+        results.append(summarize(name, times, urls=len(urls)))
+
+    base = '/sentanno/{}/'.format(collection)
+    bench('show_collection', [base])
+    bench('show_annotation', [base+n for n in names])
+    bench('pick_annotation', [base+n+'/pick?choice=positive' for n in names])
+    return results
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+"""Simulate concurrent annotators against sentanno.
+
+Each simulated annotator opens a document, presses pick hotkeys, types
+keywords (sending saves as the client does after its debounce delay)
+and navigates to the next document. Runs in-process through the WSGI
+test client on a synthetic collection (default) or a given data
+directory, or against a running server with --url.
+"""
+
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from collections import defaultdict
+
+from .common import make_app, percentile, write_results
+from .corpus import add_corpus_arguments, corpus_params, generate_collection
+
+
+PICKS = ['positive', 'neutral', 'negative', 'mixed', 'unclear']
+
+KEYWORDS = ['hinta', 'maku', 'laatu', 'palvelu', 'akun kesto', 'toimitus']
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Simulate concurrent annotators')
+    add_corpus_arguments(ap)
+    ap.add_argument('-n', '--annotators', type=int, default=10)
+    ap.add_argument('-d', '--documents-per-annotator', type=int, default=20)
+    ap.add_argument('--url', default=None,
+                    help='base URL of running server (e.g. '
+                    'http://localhost:5000/sentanno)')
+    ap.add_argument('--datadir', default=None,
+                    help='data directory for in-process runs (modified by '
+                    'the run; default: generate synthetic collection)')
+    ap.add_argument('-c', '--collection', default='synthetic')
+    ap.add_argument('--spread', default=False, action='store_true',
+                    help='start annotators at different documents')
+    ap.add_argument('--debounce', type=float, default=1.0,
+                    help='client keyword save delay (seconds)')
+    ap.add_argument('--typing-interval', type=float, default=0.15,
+                    help='delay between keystrokes (seconds)')
+    ap.add_argument('--think-time', type=float, default=0.5,
+                    help='delay between other actions (seconds)')
+    ap.add_argument('--speedup', type=float, default=1.0,
+                    help='divide all delays by this factor')
+    ap.add_argument('-o', '--output', default='-',
+                    help='JSON output file (default STDOUT)')
+    return ap
+
+
+class InProcessClient(object):
+    def __init__(self, app, prefix='/sentanno'):
+        self.client = app.test_client()
+        self.prefix = prefix
+
+    def get(self, path):
+        response = self.client.get(self.prefix + path)
+        return response.status_code, response.get_data()
+
+
+class HTTPClient(object):
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def get(self, path):
+        try:
+            with urllib.request.urlopen(self.base_url + path) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Recorder(object):
+    """Collect latencies and acknowledged metadata writes."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        # (document, field) -> (completion time, value) of last write
+        self.last_writes = {}
+
+    def request(self, client, endpoint, path):
+        start = time.perf_counter()
+        status, body = client.get(path)
+        end = time.perf_counter()
+        with self.lock:
+            self.latencies[endpoint].append(end - start)
+            if status != 200:
+                self.errors[endpoint] += 1
+        return status, body, end
+
+    def write(self, document, field, value, completed):
+        with self.lock:
+            key = (document, field)
+            if key not in self.last_writes or \
+               self.last_writes[key][0] < completed:
+                self.last_writes[key] = (completed, value)
+
+
+def annotator(client, recorder, collection, documents, start, count,
+              args, seed):
+    rng = random.Random(seed)
+    def sleep(seconds):
+        if seconds > 0 and args.speedup > 0:
+            time.sleep(seconds / args.speedup)
+
+    base = '/{}/'.format(urllib.parse.quote(collection))
+    for i in range(count):
+        document = documents[(start + i) % len(documents)]
+        doc_path = base + urllib.parse.quote(document)
+        recorder.request(client, 'show_annotation', doc_path)
+        sleep(args.think_time)
+
+        # hotkeys, sometimes changing the first choice
+        for j in range(rng.choice([1, 1, 2])):
+            choice = rng.choice(PICKS)
+            status, body, completed = recorder.request(
+                client, 'pick_annotation',
+                doc_path + '/pick?choice=' + choice)
+            if status == 200:
+                recorder.write(document, 'accepted', [choice], completed)
+            sleep(args.think_time)
+
+        # keywords, typed one character at a time; the client saves
+        # when no key is pressed within the debounce delay, with
+        # timestamps as versions
+        keywords = ', '.join(rng.sample(KEYWORDS, rng.randint(0, 2)))
+        for k in range(1, len(keywords)+1):
+            last = k == len(keywords)
+            if last or args.typing_interval >= args.debounce:
+                value = keywords[:k]
+                version = time.time_ns() // 1000
+                status, body, completed = recorder.request(
+                    client, 'save_keywords', doc_path + '/keywords?' +
+                    urllib.parse.urlencode({'keywords': value,
+                                            'version': version}))
+                if status == 200:
+                    recorder.write(document, 'keywords', value, completed)
+            sleep(args.typing_interval)
+        sleep(args.think_time)
+
+
+def count_lost_updates(client, collection, recorder):
+    """Count acknowledged writes not reflected in the final metadata."""
+    lost = 0
+    documents = set(d for d, f in recorder.last_writes)
+    for document in documents:
+        status, body = client.get('/{}/{}.json'.format(
+            urllib.parse.quote(collection), urllib.parse.quote(document)))
+        metadata = json.loads(body)
+        for field in ('accepted', 'keywords'):
+            if (document, field) not in recorder.last_writes:
+                continue
+            expected = recorder.last_writes[(document, field)][1]
+            if metadata.get(field) != expected:
+                lost += 1
+    return lost
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for endpoint, times in sorted(recorder.latencies.items()):
+        endpoints[endpoint] = {
+            'requests': len(times),
+            'errors': recorder.errors[endpoint],
+            'throughput': len(times) / elapsed,
+            'p50': percentile(times, 50),
+            'p95': percentile(times, 95),
+            'p99': percentile(times, 99),
+        }
+    total = sum(len(t) for t in recorder.latencies.values())
+    return {
+        'elapsed': elapsed,
+        'requests': total,
+        'throughput': total / elapsed,
+        'endpoints': endpoints,
+    }
+
+
+def simulate(client_factory, collection, documents, args):
+    recorder = Recorder()
+    threads = []
+    for i in range(args.annotators):
+        start = i * len(documents) // args.annotators if args.spread else 0
+        t = threading.Thread(target=annotator, args=(
+            client_factory(), recorder, collection, documents, start,
+            args.documents_per_annotator, args, args.seed + i))
+        threads.append(t)
+    start_time = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start_time
+    results = summarize(recorder, elapsed)
+    results['lost_updates'] = count_lost_updates(
+        client_factory(), collection, recorder)
+    results['writes'] = len(recorder.last_writes)
+    return results
+
+
+def _document_names(client, collection):
+    import re
+    status, body = client.get('/{}/'.format(urllib.parse.quote(collection)))
+    pattern = r'href="[^"]*/{}/([^"/]+)"'.format(re.escape(collection))
+    names = re.findall(pattern, body.decode('utf-8'))
+    return [urllib.parse.unquote(n) for n in names]
+
+
+def print_summary(results, file=sys.stderr):
+    print('{} requests in {:.1f}s ({:.1f}/s), {} lost updates in {} '
+          'writes'.format(results['requests'], results['elapsed'],
+                          results['throughput'], results['lost_updates'],
+                          results['writes']), file=file)
+    for endpoint, r in results['endpoints'].items():
+        print('{:<20} {:6d} req {:7.1f}/s  p50 {:8.2f}ms  p95 {:8.2f}ms  '
+              'p99 {:8.2f}ms  errors {}'.format(
+                  endpoint, r['requests'], r['throughput'], r['p50']*1000,
+                  r['p95']*1000, r['p99']*1000, r['errors']), file=file)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    params = corpus_params(args)
+    params.update({k: getattr(args, k) for k in (
+        'annotators', 'documents_per_annotator', 'url', 'spread', 'debounce',
+        'typing_interval', 'think_time', 'speedup')})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.url is not None:
+            client_factory = lambda: HTTPClient(args.url)
+        else:
+            datadir = args.datadir
+            if datadir is None:
+                datadir = tmpdir
+                generate_collection(datadir, args.collection,
+                                    **corpus_params(args))
+            app = make_app(datadir, tmpdir)
+            client_factory = lambda: InProcessClient(app)
+        documents = _document_names(client_factory(), args.collection)
+        if not documents:
+            print('no documents in {}'.format(args.collection),
+                  file=sys.stderr)
+            return 1
+        results = simulate(client_factory, args.collection, documents, args)
+    print_summary(results)
+    write_results(args.output, params, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
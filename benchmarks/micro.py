@@ -0,0 +1,72 @@
+"""Micro-benchmarks for the parsing, layout and rendering hot paths."""
+
+from collections import OrderedDict
+
+from .common import measure, summarize
+
+
+def _load_documents(app, collection, names):
+    from sentanno.db import get_db
+    db = get_db()
+    documents = []
+    for name in names:
+        text = db.get_document_text(collection, name)
+        standoff = db.get_document_annotation(collection, name, 'ann')
+        metadata = db.get_document_metadata(collection, name)
+        documents.append((text, standoff, metadata))
+    return documents
+
+
+def _document_data(text, standoff, metadata):
+    from sentanno.db import DocumentData
+    from sentanno.standoff import parse_standoff
+    annsets = OrderedDict()
+    annsets['ann'] = parse_standoff(standoff)
+    return DocumentData(text, annsets, metadata)
+
+
+def run(app, collection, names, repeat=20):
+    from sentanno.standoff import parse_standoff
+    from sentanno.so2html import Span, resolve_heights, standoff_to_html
+    from sentanno.visualize import (
+        _text_width, _split_text, _add_highlight_annotations,
+        _find_covering_span
+    )
+
+    results = []
+    def bench(name, func, setup=lambda *document: document):
+        # func is called with the value returned by setup(text,
+        # standoff, metadata) for each document
+        times = []
+        for document in documents:
+            times.extend(measure(func, lambda: setup(*document), repeat))
+        results.append(summarize(name, times))
+
+    with app.app_context():
+        documents = _load_documents(app, collection, names)
+        _text_width('')    # exclude font loading
+
+        bench('parse_standoff', lambda d: parse_standoff(d[1]))
+
+        bench('filter_to_candidate', lambda d: d.filter_to_candidate(),
+              _document_data)
+
+        bench('_text_width', lambda d: _text_width(d[0]))
+
+        def split_setup(t, s, m):
+            d = _document_data(t, s, m).filter_to_candidate()
+            return (t,) + _find_covering_span(t, d.annsets)
+        bench('_split_text', lambda a: _split_text(*a), split_setup)
+
+        bench('_add_highlight_annotations',
+              lambda d: _add_highlight_annotations(d.text, d.annsets),
+              _document_data)
+
+        def spans_setup(t, s, m):
+            return [Span(a.start, a.end, a.type) for a in parse_standoff(s)]
+        bench('resolve_heights', resolve_heights, spans_setup)
+
+        bench('standoff_to_html',
+              lambda d: standoff_to_html(d.text, d.annsets['ann']),
+              _document_data)
+    return results
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Compare cold-read latency and disk footprint of plain and compressed
+document storage.
+
+Usage: python3 -m benchmarks.storage [options] [-o results.json]
+
+Cold reads evict document files from the OS page cache (where
+supported) and the parsed document cache before each read. This does
+not evict caches of network file servers, so run against the storage
+of interest with a corpus larger than its cache for NFS numbers.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+from .common import measure, summarize, make_app, write_results
+from .common import print_results
+from .corpus import add_corpus_arguments, corpus_params, generate_collection
+
+
+FORMATS = ['none', 'gz', 'xz']
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Benchmark compressed storage')
+    add_corpus_arguments(ap)
+    ap.add_argument('-f', '--format', choices=FORMATS, action='append',
+                    help='storage formats to compare (default all)')
+    ap.add_argument('-l', '--level', type=int, default=6,
+                    help='compression level (default 6)')
+    ap.add_argument('-r', '--repeat', type=int, default=3,
+                    help='cold reads per document')
+    ap.add_argument('-o', '--output', default='-',
+                    help='JSON output file (default STDOUT)')
+    return ap
+
+
+def _evict(path):
+    # Drop file from the page cache, if supported
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def footprint(db, collection, names):
+    """Return (bytes, allocated bytes) of document texts and
+    annotations."""
+    size, allocated = 0, 0
+    for name in names:
+        for ext in ('txt', 'ann'):
+            st = os.stat(db.get_document_path(collection, name, ext))
+            size += st.st_size
+            allocated += st.st_blocks * 512
+    return size, allocated
+
+
+def run(app, collection, names, fmt, level=6, repeat=3):
+    from sentanno.db import get_db, document_cache
+    from sentanno.compress import FORMATS, recompress_collection
+
+    with app.app_context():
+        db = get_db()
+        recompress_collection(db, collection, FORMATS[fmt], level)
+        size, allocated = footprint(db, collection, names)
+        times = []
+        for name in names:
+            paths = [db.get_document_path(collection, name, ext)
+                     for ext in ('txt', 'ann')]
+            def setup():
+                for path in paths:
+                    _evict(path)
+                document_cache.clear()
+            def read(_):
+                db.cache_document(collection, name)
+            times.extend(measure(read, setup, repeat))
+    return summarize('cold_read_{}'.format(fmt), times, bytes=size,
+                     allocated=allocated)
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    params = corpus_params(args)
+    formats = args.format or FORMATS
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, 'source')
+        names = generate_collection(source, 'synthetic', **params)
+        for fmt in formats:
+            datadir = os.path.join(tmpdir, fmt)
+            shutil.copytree(source, datadir)
+            app = make_app(datadir, tmpdir)
+            results.append(run(app, 'synthetic', names, fmt, args.level,
+                               args.repeat))
+    params.update(formats=formats, level=args.level, repeat=args.repeat)
+    print_results(results)
+    for r in results:
+        print('{:<40} {:>12} bytes {:>12} allocated'.format(
+            r['name'], r['bytes'], r['allocated']), file=sys.stderr)
+    write_results(args.output, params, results)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""Multi-threaded rendering stress test.
+
+Renders document pages sequentially for reference output, then again
+from many threads in random order, and checks that every concurrently
+rendered page is identical to its reference. Exits with status 1 on
+any mismatch or error. RENDER_TIME_BUDGET is disabled, as renders
+degraded to fit it under the short switch interval would differ from
+the reference without anything being wrong.
+"""
+
+import sys
+import random
+import tempfile
+import threading
+
+from .common import make_app
+from .corpus import add_corpus_arguments, corpus_params, generate_collection
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Concurrent rendering stress test')
+    add_corpus_arguments(ap)
+    ap.set_defaults(documents=20, overlap=0.3)
+    ap.add_argument('-t', '--threads', type=int, default=16)
+    ap.add_argument('-i', '--iterations', type=int, default=50,
+                    help='pages rendered per thread')
+    ap.add_argument('--switch-interval', type=float, default=1e-6,
+                    help='thread switch interval (sys.setswitchinterval)')
+    ap.add_argument('--render-cache', default=False, action='store_true',
+                    help='keep visualization cache (default: render each '
+                    'page)')
+    return ap
+
+
+def page_urls(collection, names):
+    base = '/sentanno/{}/'.format(collection)
+    urls = []
+    for name in names:
+        urls.extend([base+name, base+name+'.all'])
+    return urls
+
+
+def render(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise ValueError('{}: status {}'.format(url, response.status_code))
+    return response.get_data()
+
+
+def stress(app, urls, threads, iterations, seed=0):
+    """Return list of (url, problem) found rendering urls concurrently."""
+    client = app.test_client()
+    reference = { url: render(client, url) for url in urls }
+    problems = []
+    lock = threading.Lock()
+    def worker(i):
+        rng = random.Random(seed + i)
+        client = app.test_client()
+        for j in range(iterations):
+            url = rng.choice(urls)
+            try:
+                if render(client, url) != reference[url]:
+                    problem = 'output differs from reference'
+                else:
+                    continue
+            except Exception as e:
+                problem = 'error: {}'.format(e)
+            with lock:
+                problems.append((url, problem))
+    workers = [threading.Thread(target=worker, args=(i,))
+               for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return problems
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    sys.setswitchinterval(args.switch_interval)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        names = generate_collection(tmpdir, 'stress', **corpus_params(args))
+        app = make_app(tmpdir, tmpdir, RENDER_TIME_BUDGET=float('inf'))
+        from sentanno.render import render_cache
+        if not args.render_cache:
+            render_cache.maxsize = 0
+        urls = page_urls('stress', names)
+        problems = stress(app, urls, args.threads, args.iterations, args.seed)
+    for url, problem in problems:
+        print('{}: {}'.format(url, problem), file=sys.stderr)
+    total = args.threads * args.iterations
+    print('{}/{} concurrent renders differed or failed'.format(
+        len(problems), total), file=sys.stderr)
+    print('visualization cache: {} hits, {} misses'.format(
+        render_cache.hits, render_cache.misses), file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -2,4 +2,5 @@
 
 export FLASK_APP=sentanno
 export FLASK_ENV=development
+python3 -m sentanno.fontmetrics    # precompile font metrics
 flask run
@@ -1,20 +1,41 @@
 import os
+import time
 
 from flask import Flask, redirect
 
 
 def create_app():
+    start_time = time.time()
     app = Flask(__name__)
     #app = Flask(__name__, instance_relative_config=True)
 
     # Allow zip() in templates (https://stackoverflow.com/a/5223810)
     app.jinja_env.globals.update(zip=zip)
+    # Mark points where streamed templates send output so far (see
+    # view._join_until_flush)
+    app.jinja_env.globals.update(flush='')
 
     app.config.from_pyfile('config.py') #, silent=True)
 
+    from . import warmup
+    if app.config['JINJA_BYTECODE_CACHE']:
+        warmup.init_bytecode_cache(app)
+
     from . import db
     db.init(app)
 
+    from . import conditional
+    conditional.init(app)
+
+    from . import profiling
+    profiling.init(app)
+
+    from . import render
+    render.init(app)
+
+    from . import assign
+    assign.init(app)
+
     from . import view
     app.register_blueprint(view.bp)
 
@@ -22,4 +43,10 @@ def create_app():
     def root_redirect():
         return redirect('sentanno')
 
+    if app.config['WARMUP']:
+        warmup.warm_up(app)
+
+    from . import metrics
+    metrics.init(app, start_time)
+
     return app
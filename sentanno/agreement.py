@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+
+import numpy as np
+
+from flask import current_app as app
+
+from .db import get_db, candidate_entries
+
+
+# Judgments are represented as a matrix of label codes with a row for
+# each document (or candidate) and a column for each annotator, with
+# MISSING where the annotator has not judged the document. Label codes
+# are indices into the list of labels (ANNOTATION_OPTIONS).
+
+MISSING = -1
+
+
+def judgment_label(judgment):
+    """Return the label of a judgment (accepted and rejected picks),
+    or None if nothing was accepted."""
+    accepted = judgment.get('accepted')
+    return accepted[0] if accepted else None
+
+
+def collect_judgments(db, collection, labels):
+    """Return (documents, annotators, codes) for the per-annotator
+    judgments in collection, where codes is a documents x annotators
+    label code matrix. Candidates of documents with several are
+    included as "<document>/<candidate_id>"."""
+    label_index = { l: i for i, l in enumerate(labels) }
+    annotator_index = {}
+    documents, rows, columns, values = [], [], [], []
+    for document in db.get_documents(collection):
+        try:
+            metadata = db.get_document_metadata(collection, document)
+        except Exception as e:
+            app.logger.warning('Skipping {}/{}: {}'.format(
+                collection, document, e))
+            continue
+        for candidate_id, data in candidate_entries(metadata):
+            judgments = data.get('judgments') or {}
+            row = len(documents)
+            for annotator, judgment in judgments.items():
+                code = label_index.get(judgment_label(judgment))
+                if code is None:
+                    continue
+                rows.append(row)
+                columns.append(annotator_index.setdefault(
+                    annotator, len(annotator_index)))
+                values.append(code)
+            if candidate_id is None:
+                documents.append(document)
+            else:
+                documents.append('{}/{}'.format(document, candidate_id))
+    codes = np.full((len(documents), len(annotator_index)), MISSING,
+                    dtype=np.int16)
+    codes[rows, columns] = values
+    annotators = sorted(annotator_index, key=annotator_index.get)
+    return documents, annotators, codes
+
+
+def confusion_matrix(a, b, n_labels):
+    """Return n_labels x n_labels matrix of counts of label pairs in
+    label code arrays a (rows) and b (columns)."""
+    pairs = a.astype(np.int64) * n_labels + b
+    counts = np.bincount(pairs, minlength=n_labels*n_labels)
+    return counts.reshape(n_labels, n_labels)
+
+
+def cohen_kappa(confusion):
+    """Return Cohen's kappa for a confusion matrix of two annotators,
+    or None if undefined."""
+    total = confusion.sum()
+    if total == 0:
+        return None
+    observed = np.trace(confusion) / total
+    expected = (confusion.sum(axis=1) @ confusion.sum(axis=0)) / total**2
+    if expected == 1:
+        return None
+    return float((observed - expected) / (1 - expected))
+
+
+def label_counts(codes, n_labels):
+    """Return documents x n_labels matrix of the number of annotators
+    giving each label to each document."""
+    rows, columns = np.nonzero(codes != MISSING)
+    flat = rows.astype(np.int64) * n_labels + codes[rows, columns]
+    counts = np.bincount(flat, minlength=codes.shape[0]*n_labels)
+    return counts.reshape(codes.shape[0], n_labels)
+
+
+def fleiss_kappa(counts):
+    """Return Fleiss' kappa for a documents x labels matrix of label
+    counts, over documents with at least two judgments, or None if
+    undefined. Documents may have different numbers of judgments."""
+    raters = counts.sum(axis=1)
+    counts, raters = counts[raters >= 2], raters[raters >= 2]
+    if len(raters) == 0:
+        return None
+    agreement = ((counts * (counts - 1)).sum(axis=1) /
+                 (raters * (raters - 1)))
+    observed = agreement.mean()
+    proportions = counts.sum(axis=0) / raters.sum()
+    expected = (proportions ** 2).sum()
+    if expected == 1:
+        return None
+    return float((observed - expected) / (1 - expected))
+
+
+def compute_agreement(annotators, codes, labels):
+    """Return agreement statistics for label code matrix: Fleiss' kappa
+    over all annotators and, for each pair of annotators, the number of
+    documents judged by both, Cohen's kappa and confusion matrix."""
+    n_labels = len(labels)
+    judged = codes != MISSING
+    pairs = []
+    for i in range(len(annotators)):
+        for j in range(i+1, len(annotators)):
+            both = judged[:, i] & judged[:, j]
+            count = int(both.sum())
+            if count == 0:
+                continue
+            confusion = confusion_matrix(codes[both, i], codes[both, j],
+                                         n_labels)
+            pairs.append({
+                'annotators': [annotators[i], annotators[j]],
+                'documents': count,
+                'kappa': cohen_kappa(confusion),
+                'confusion': confusion.tolist(),
+            })
+    return {
+        'labels': list(labels),
+        'annotators': list(annotators),
+        'documents': int(judged.any(axis=1).sum()),
+        'judgments': int(judged.sum()),
+        'fleiss_kappa': fleiss_kappa(label_counts(codes, n_labels)),
+        'pairs': pairs,
+    }
+
+
+def collection_agreement(db, collection, labels):
+    documents, annotators, codes = collect_judgments(db, collection, labels)
+    return compute_agreement(annotators, codes, labels)
+
+
+def _format_kappa(kappa):
+    return 'n/a' if kappa is None else '{:.3f}'.format(kappa)
+
+
+def print_agreement(result, out=sys.stdout):
+    print('{} judgments of {} documents by {} annotators'.format(
+        result['judgments'], result['documents'], len(result['annotators'])),
+          file=out)
+    print("Fleiss' kappa: {}".format(_format_kappa(result['fleiss_kappa'])),
+          file=out)
+    labels = result['labels']
+    width = max(len(l) for l in labels)
+    for pair in result['pairs']:
+        print('\n{} / {}: {} documents, kappa {}'.format(
+            *pair['annotators'], pair['documents'],
+            _format_kappa(pair['kappa'])), file=out)
+        print(' '*width, *(l.rjust(width) for l in labels), file=out)
+        for label, row in zip(labels, pair['confusion']):
+            print(label.ljust(width), *(str(c).rjust(width) for c in row),
+                  file=out)
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Inter-annotator agreement')
+    ap.add_argument('-d', '--datadir', default=None,
+                    help='data directory (default from config)')
+    ap.add_argument('-j', '--json', default=False, action='store_true',
+                    help='output JSON')
+    ap.add_argument('collection')
+    return ap
+
+
+def main(argv):
+    from . import create_app
+    args = argparser().parse_args(argv[1:])
+    app = create_app()
+    if args.datadir is not None:
+        app.config['DATADIR'] = args.datadir
+    with app.app_context():
+        result = collection_agreement(get_db(), args.collection,
+                                      app.config['ANNOTATION_OPTIONS'])
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_agreement(result)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
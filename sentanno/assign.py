@@ -0,0 +1,217 @@
+import heapq
+import threading
+import time
+import uuid
+
+from flask import request, g
+from flask import current_app as app
+
+from . import metrics
+from .db import get_db, is_judged
+
+
+ANNOTATOR_COOKIE = 'sentanno_annotator'
+
+
+class Scheduler(object):
+    """Assignment of the unjudged documents of a collection to
+    annotators as time-limited leases.
+
+    Free documents are kept in a heap by their position in the
+    collection and leases in a heap by expiry time, so assignment is
+    O(log n) in the number of documents. Heap entries for documents
+    that have since been judged or leased are skipped when popped.
+    Each annotator holds at most one lease.
+    """
+    def __init__(self, documents, judged, lease_seconds):
+        self.documents = documents
+        self.lease_seconds = lease_seconds
+        self.judged = set(judged)
+        self.position = { d: i for i, d in enumerate(documents) }
+        self.free = [(i, d) for i, d in enumerate(documents)
+                     if d not in self.judged]
+        heapq.heapify(self.free)
+        self.leases = {}         # document -> (annotator, expires)
+        self.by_annotator = {}   # annotator -> document
+        self.expiry = []         # (expires, document, annotator)
+        self.version = None      # of collection documents
+        self.lock = threading.Lock()
+
+    def _release(self, document):
+        annotator, expires = self.leases.pop(document)
+        del self.by_annotator[annotator]
+        if document not in self.judged:
+            heapq.heappush(self.free, (self.position[document], document))
+
+    def _reclaim_expired(self, now):
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, document, annotator = heapq.heappop(self.expiry)
+            if self.leases.get(document) == (annotator, expires):
+                self._release(document)
+                metrics.inc('sentanno_leases_expired_total')
+
+    def _lease(self, document, annotator, now):
+        expires = now + self.lease_seconds
+        self.leases[document] = (annotator, expires)
+        self.by_annotator[annotator] = document
+        heapq.heappush(self.expiry, (expires, document, annotator))
+
+    def _pop_free(self):
+        while self.free:
+            position, document = heapq.heappop(self.free)
+            if document not in self.judged and document not in self.leases:
+                return document
+        return None
+
+    def assign(self, annotator, skip_current=False):
+        """Return document leased to annotator, leasing the next free
+        document if the annotator has no unjudged document or
+        skip_current is True. Return None if no documents are free."""
+        with self.lock:
+            now = time.time()
+            self._reclaim_expired(now)
+            current = self.by_annotator.get(annotator)
+            if current is not None:
+                if current not in self.judged and not skip_current:
+                    self._lease(current, annotator, now)    # renew
+                    return current
+                # taken before releasing to avoid getting it back
+                document = self._pop_free()
+                self._release(current)
+            else:
+                document = self._pop_free()
+            if document is not None:
+                self._lease(document, annotator, now)
+                metrics.inc('sentanno_leases_total')
+            return document
+
+    def take(self, annotator, document, expires):
+        """Lease document to annotator until expires if it is free."""
+        with self.lock:
+            if (document in self.position and document not in self.judged
+                    and document not in self.leases and
+                    annotator not in self.by_annotator):
+                self._lease(document, annotator, expires-self.lease_seconds)
+
+    def renew(self, annotator, document):
+        """Extend lease of annotator on document, if any."""
+        with self.lock:
+            now = time.time()
+            self._reclaim_expired(now)
+            if self.leases.get(document, (None,))[0] == annotator:
+                self._lease(document, annotator, now)
+
+    def set_judged(self, document, judged):
+        with self.lock:
+            if document not in self.position:
+                return
+            if judged:
+                self.judged.add(document)
+            elif document in self.judged:
+                self.judged.discard(document)
+                if document not in self.leases:
+                    heapq.heappush(self.free,
+                                   (self.position[document], document))
+
+    def status(self):
+        with self.lock:
+            self._reclaim_expired(time.time())
+            return {
+                'documents': len(self.documents),
+                'judged': len(self.judged),
+                'leased': len(self.leases),
+            }
+
+
+# Schedulers by (data directory, collection). Lease state is kept in
+# process memory: run the app in a single process (with threads) when
+# using assignment.
+
+_schedulers = {}
+
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(collection):
+    """Return Scheduler for collection, creating it (reading the
+    metadata of all documents) on first use and when the collection
+    changes."""
+    db = get_db()
+    version = db.get_collection_version(collection)
+    key = (db.root_dir, collection)
+    with _schedulers_lock:
+        scheduler = _schedulers.get(key)
+        if scheduler is not None and scheduler.version == version:
+            return scheduler
+        documents = db.get_documents(collection)
+        if scheduler is not None and scheduler.documents == documents:
+            # directory changed by metadata writes of other processes
+            scheduler.version = version
+            return scheduler
+        judged = []
+        for document in documents:
+            try:
+                metadata = db.get_document_metadata(collection, document)
+            except FileNotFoundError:
+                continue
+            if is_judged(metadata):
+                judged.append(document)
+        new = Scheduler(documents, judged,
+                        app.config['ASSIGNMENT_LEASE_SECONDS'])
+        new.version = version
+        if scheduler is not None:
+            # keep leases on documents still in the collection
+            with scheduler.lock:
+                leases = list(scheduler.leases.items())
+            for document, (annotator, expires) in leases:
+                new.take(annotator, document, expires)
+        _schedulers[key] = new
+        return new
+
+
+def get_annotator():
+    """Return identifier of the annotator making the request: the
+    authenticated user if any, otherwise a random identifier kept in a
+    cookie."""
+    if request.remote_user:
+        return request.remote_user
+    annotator = request.cookies.get(ANNOTATOR_COOKIE)
+    if not annotator:
+        annotator = g.get('new_annotator')
+        if annotator is None:
+            annotator = g.new_annotator = uuid.uuid4().hex
+    return annotator
+
+
+def renew_lease(collection, document):
+    """Renew lease of requesting annotator on document (on activity)."""
+    if not app.config['ASSIGNMENT']:
+        return
+    try:
+        get_scheduler(collection).renew(get_annotator(), document)
+    except Exception as e:
+        app.logger.warning('Failed to renew lease: {}'.format(e))
+
+
+def document_updated(collection, document):
+    """Update scheduler after document metadata was written."""
+    if not app.config['ASSIGNMENT']:
+        return
+    db = get_db()
+    scheduler = _schedulers.get((db.root_dir, collection))
+    if scheduler is not None:
+        metadata = db.get_document_metadata(collection, document)
+        scheduler.set_judged(document, is_judged(metadata))
+
+
+def _set_annotator_cookie(response):
+    annotator = g.get('new_annotator')
+    if annotator is not None:
+        response.set_cookie(ANNOTATOR_COOKIE, annotator,
+                            max_age=365*24*60*60, httponly=True,
+                            samesite='Lax')
+    return response
+
+
+def init(app):
+    app.after_request(_set_annotator_cookie)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import lzma
+
+from tempfile import mkstemp
+
+from .db import get_db, COMPRESSION_OPENERS, split_compression
+
+
+# Document texts and annotations are compressed one file per document,
+# so that any document can be read by decompressing only its own
+# files. The LZMA dictionary is limited to the file size, as the
+# default (8M at preset 6) would make decompressing small files
+# dominated by allocating the dictionary.
+
+FORMATS = {
+    'none': '',
+    'gz': '.gz',
+    'xz': '.xz',
+}
+
+CONTENT_EXTENSIONS = ('txt', 'ann')
+
+
+def _lzma_dict_size(size):
+    dict_size = 4096    # LZMA2 minimum
+    while dict_size < size:
+        dict_size *= 2
+    return dict_size
+
+
+def compress_data(data, compression, level=6):
+    """Return bytes data compressed with compression extension."""
+    if compression == '.gz':
+        return gzip.compress(data, level, mtime=0)
+    elif compression == '.xz':
+        filters = [{
+            'id': lzma.FILTER_LZMA2,
+            'preset': level,
+            'dict_size': _lzma_dict_size(len(data)),
+        }]
+        return lzma.compress(data, lzma.FORMAT_XZ, lzma.CHECK_CRC32,
+                             filters=filters)
+    elif not compression:
+        return data
+    raise ValueError(compression)
+
+
+def recompress_file(path, compression, level=6):
+    """Replace stored document file path with variant compressed with
+    compression extension ('' for plain), keeping its modification time.
+    Return (size before, size after)."""
+    name, current = split_compression(path)
+    st = os.stat(path)
+    if current == compression:
+        return st.st_size, st.st_size
+    opener = COMPRESSION_OPENERS.get(current, open)
+    with opener(path, 'rb') as f:
+        data = compress_data(f.read(), compression, level)
+    target = name + compression
+    fd, tmpfn = mkstemp(dir=os.path.dirname(path), prefix='.',
+                        suffix='.tmp')
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.utime(tmpfn, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmpfn, target)
+    except BaseException:
+        os.remove(tmpfn)
+        raise
+    os.remove(path)
+    return st.st_size, len(data)
+
+
+def recompress_collection(db, collection, compression, level=6):
+    """Recompress texts and annotations of documents in collection.
+    Return (files, bytes before, bytes after, files unlinked), where
+    files unlinked were hard links (e.g. deduplicated by ingest.py)
+    replaced with files of their own."""
+    files, before, after, unlinked = 0, 0, 0, 0
+    for document in db.get_documents(collection):
+        for ext in CONTENT_EXTENSIONS:
+            path = db.get_document_path(collection, document, ext)
+            if not os.path.exists(path):
+                continue
+            if (split_compression(path)[1] != compression and
+                    os.stat(path).st_nlink > 1):
+                unlinked += 1
+            b, a = recompress_file(path, compression, level)
+            files += 1
+            before += b
+            after += a
+    return files, before, after, unlinked
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Recompress document texts and '
+                        'annotations')
+    ap.add_argument('-d', '--datadir', default=None,
+                    help='data directory (default from config)')
+    ap.add_argument('-f', '--format', choices=sorted(FORMATS), default='gz',
+                    help='compression format (default gz)')
+    ap.add_argument('-l', '--level', type=int, default=6,
+                    help='compression level (default 6)')
+    ap.add_argument('collection', nargs='*',
+                    help='collections to recompress (default all)')
+    return ap
+
+
+def main(argv):
+    from . import create_app
+    args = argparser().parse_args(argv[1:])
+    app = create_app()
+    if args.datadir is not None:
+        app.config['DATADIR'] = args.datadir
+    with app.app_context():
+        db = get_db()
+        for collection in args.collection or db.get_collections():
+            files, before, after, unlinked = recompress_collection(
+                db, collection, FORMATS[args.format], args.level)
+            print('{}: {} files, {} -> {} bytes'.format(
+                collection, files, before, after))
+            if unlinked:
+                print('{}: {} files no longer share their payload, run '
+                      'sentanno.ingest to deduplicate them again'.format(
+                          collection, unlinked), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
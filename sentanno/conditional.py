@@ -0,0 +1,184 @@
+import os
+import gzip
+import zlib
+import hashlib
+
+from datetime import datetime, timezone
+from functools import wraps
+from tempfile import mkstemp
+
+from flask import request, make_response
+from flask import current_app as app
+from werkzeug.http import is_resource_modified
+
+from sentanno import conf
+from . import assign
+from .db import get_db
+
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/javascript',
+}
+
+
+def code_mtime():
+    """Return latest modification time of code, templates and config."""
+    if code_mtime.cache is None:
+        latest = 0
+        for dirpath, dirnames, filenames in os.walk(app.root_path):
+            dirnames[:] = [d for d in dirnames if d != '__pycache__']
+            for fn in filenames:
+                mtime = os.path.getmtime(os.path.join(dirpath, fn))
+                latest = max(latest, mtime)
+        code_mtime.cache = latest
+    return code_mtime.cache
+code_mtime.cache = None
+
+
+def document_validators(collection, document, neighbours=False,
+                        variant=()):
+    """Return (etag, last_modified) for document endpoint responses.
+
+    The validators derive from the mtimes and sizes of the document
+    files and the code. If neighbours is True, also include the names
+    of the previous and next documents, which HTML views link to.
+    variant lists further values the response depends on, e.g. the
+    candidate and annotator shown.
+    """
+    db = get_db()
+    stats = db.get_document_stats(collection, document)
+    parts = [request.endpoint, collection, document, str(code_mtime())]
+    parts.extend(str(v) for v in variant)
+    parts.extend('{}:{}:{}'.format(*s) for s in stats)
+    if neighbours:
+        parts.extend(str(d) for d in db.get_neighbouring_documents(
+            collection, document))
+    etag = hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+    mtime = max([code_mtime()] + [s[1] for s in stats])
+    last_modified = datetime.fromtimestamp(int(mtime), timezone.utc)
+    return etag, last_modified
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True    # always revalidate
+    return response
+
+
+def validated(neighbours=False, per_annotator=False, leased=False):
+    """Decorator adding ETag and Last-Modified to document views and
+    answering conditional requests with 304 without invoking the view.
+    If per_annotator is True and PER_ANNOTATOR_JUDGMENTS is set, the
+    response shows the judgments of the requesting annotator and is
+    validated and cached per annotator. If leased is True, viewing the
+    document renews the lease of the annotator on it (see assign.py)
+    also when answered with 304."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(collection, document, **kwargs):
+            variant = []
+            if kwargs.get('candidate_id') is not None:
+                variant.append(kwargs['candidate_id'])
+            private = per_annotator and app.config['PER_ANNOTATOR_JUDGMENTS']
+            if private:
+                variant.append(assign.get_annotator())
+            try:
+                etag, last_modified = document_validators(
+                    collection, document, neighbours, variant)
+            except Exception as e:
+                # Let the view itself deal with missing documents etc.
+                app.logger.warning('No validators for {}/{}: {}'.format(
+                    collection, document, e))
+                return view(collection, document, **kwargs)
+            if not is_resource_modified(request.environ, etag=etag,
+                                        last_modified=last_modified):
+                response = app.response_class(status=304)
+                if leased:
+                    assign.renew_lease(collection, document)
+            else:
+                response = make_response(
+                    view(collection, document, **kwargs))
+            if private:
+                response.cache_control.private = True
+                response.vary.add('Cookie')
+            return set_validators(response, etag, last_modified)
+        return wrapper
+    return decorator
+
+
+def accepts_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+
+def is_compressible(response):
+    return (response.mimetype.startswith('text/') or
+            response.mimetype in COMPRESSIBLE_MIMETYPES)
+
+
+def _gzip_stream(chunks, level):
+    """Gzip chunks, flushing after each so that the client receives
+    every chunk as soon as it is generated."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    for chunk in chunks:
+        if chunk:
+            yield (compressor.compress(chunk) +
+                   compressor.flush(zlib.Z_SYNC_FLUSH))
+    yield compressor.flush()
+
+
+def compress_response(response):
+    """Gzip response body if the client accepts it (after_request)."""
+    if response.direct_passthrough or not is_compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or
+            'Content-Encoding' in response.headers or
+            not accepts_gzip()):
+        return response
+    if response.is_streamed:
+        response.response = _gzip_stream(response.iter_encoded(),
+                                          app.config['COMPRESS_LEVEL'])
+        response.headers.pop('Content-Length', None)
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, app.config['COMPRESS_LEVEL'],
+                                    mtime=0))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def precompressed_path(path):
+    """Return path to up-to-date gzipped variant of file, or None if
+    the file is too small to benefit from precompression.
+
+    A <path>.gz variant next to the file is used if present and newer
+    than the file; otherwise a variant is created in the temp dir.
+    """
+    st = os.stat(path)
+    if st.st_size < app.config['PRECOMPRESS_MIN_SIZE']:
+        return None
+    sibling = path + '.gz'
+    if os.path.exists(sibling) and os.path.getmtime(sibling) >= st.st_mtime:
+        return sibling
+    cache_dir = os.path.join(conf.get_tempdir(), 'precompressed')
+    key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    cached = os.path.join(cache_dir, key + '.gz')
+    if os.path.exists(cached) and os.path.getmtime(cached) >= st.st_mtime:
+        return cached
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, 'rb') as f:
+        data = gzip.compress(f.read(), 9, mtime=0)
+    fd, tmpfn = mkstemp(dir=cache_dir)
+    with open(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmpfn, cached)
+    return cached
+
+
+def init(app):
+    app.after_request(compress_response)
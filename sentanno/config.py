@@ -62,3 +62,138 @@ HOTKEYS = {
 STATUS_COMPLETE = 'complete'
 STATUS_INCOMPLETE = 'todo'
 STATUS_ERROR = 'ERROR'
+
+# HTTP caching and compression
+
+COMPRESS_MIN_SIZE = 1024           # bytes, smaller responses sent as-is
+COMPRESS_LEVEL = 6                 # gzip compression level (1-9)
+PRECOMPRESS_MIN_SIZE = 64 * 1024   # bytes, store gzipped variants of texts
+
+# File serving. Set USE_X_SENDFILE = True for Apache mod_xsendfile, or
+# X_ACCEL_REDIRECT_PREFIX to an nginx internal location aliasing DATADIR
+# (e.g. '/sentanno-data') to have the front-end server send texts and
+# annotations.
+
+USE_X_SENDFILE = False
+X_ACCEL_REDIRECT_PREFIX = None
+
+# Caches of collection listings, parsed documents and document
+# visualizations (entries)
+
+LISTING_CACHE_SIZE = 1000
+DOCUMENT_CACHE_SIZE = 1000
+RENDER_CACHE_SIZE = 1000
+
+# Warm-up at app creation: load font metrics, compile templates, list
+# collections and parse the WARMUP_DOCUMENTS most recently modified
+# documents. Enable when the app is loaded before workers are forked
+# (e.g. mod_wsgi WSGIImportScript, gunicorn --preload) so that workers
+# share the loaded data copy-on-write.
+
+WARMUP = False
+WARMUP_DOCUMENTS = 100
+
+# Cache compiled templates in TEMPDIR
+
+JINJA_BYTECODE_CACHE = True
+
+# Time request phases for Server-Timing headers and /sentanno/metrics
+
+REQUEST_TIMING = True
+
+# Profiling of sampled requests and requests with PROFILE_HEADER or
+# PROFILE_QUERY_FLAG. Profiles are saved in TEMPDIR/profiles and listed
+# at /sentanno/profiles/
+
+PROFILING = False
+PROFILE_SAMPLE_RATE = 0.01     # fraction of requests to profile
+PROFILE_HEADER = 'X-Sentanno-Profile'
+PROFILE_QUERY_FLAG = 'profile'
+PROFILE_TRACEMALLOC = True     # also capture allocation snapshots
+PROFILE_KEEP = 200             # number of most recent profiles to keep
+
+# Render document visualizations in a pool of RENDER_POOL_SIZE processes
+# (0: render in request thread). When RENDER_QUEUE_SIZE renders are
+# waiting or a render takes longer than RENDER_TIMEOUT seconds, a
+# simplified visualization is returned instead. RENDER_POOL_PYTHON sets
+# the interpreter for worker processes (needed e.g. under mod_wsgi).
+
+RENDER_POOL_SIZE = 0
+RENDER_QUEUE_SIZE = 8
+RENDER_TIMEOUT = 2.0
+RENDER_POOL_START_METHOD = 'spawn'
+RENDER_POOL_PYTHON = None
+
+# Stream document pages: the page head, navigation, candidate line and
+# annotation controls are sent before the context above and below the
+# candidate line, which a script then moves into place. Streamed
+# responses are compressed with a flush after each chunk.
+
+STREAM_PAGES = True
+
+# Offline client: picks and keywords are queued in the browser
+# (IndexedDB) and synced to the server in batches, and a service worker
+# caches static files and the OFFLINE_PREFETCH_DOCUMENTS documents
+# following the current one. Service workers require HTTPS (or
+# localhost); without one only the queueing is used.
+
+OFFLINE_CLIENT = False
+OFFLINE_PREFETCH_DOCUMENTS = 10
+
+# Characters of context rendered above and below the candidate line,
+# also the size of further context chunks loaded as the user scrolls
+
+CONTEXT_WINDOW_CHARS = 2000
+
+# Show a control for loading context beyond CONTEXT_WINDOW_CHARS
+# (False: only note its length, for pages without a server)
+
+CONTEXT_LOAD_CONTROLS = True
+
+# Render budget: documents with more than RENDER_MAX_SPANS candidate or
+# highlight spans or RENDER_MAX_HIGHLIGHT_PATTERNS distinct mention
+# strings to highlight, or whose highlighting takes more than
+# RENDER_TIME_BUDGET seconds, get a layout with highlighting only on
+# the candidate line.
+
+RENDER_MAX_SPANS = 100
+RENDER_MAX_HIGHLIGHT_PATTERNS = 20
+RENDER_TIME_BUDGET = 0.5
+
+# Assignment of documents to annotators: the "next" navigation leases
+# each annotator the next unjudged document not leased to others for
+# ASSIGNMENT_LEASE_SECONDS, renewed on activity. Annotators are
+# identified by REMOTE_USER or a cookie. Leases are kept in process
+# memory, so run a single (threaded) server process with assignment.
+
+ASSIGNMENT = False
+ASSIGNMENT_LEASE_SECONDS = 15*60
+
+# Search index (SQLite FTS5) of document texts, annotated strings and
+# keywords, relative to the data directory (None to disable). Build and
+# update with `python3 -m sentanno.search`; keywords are also updated
+# when saved, once the index has been built. Matches in annotated strings and keywords count
+# SEARCH_STRING_WEIGHT and SEARCH_KEYWORD_WEIGHT times a match in text.
+
+SEARCH_INDEX = '.search.sqlite'
+SEARCH_STRING_WEIGHT = 2.0
+SEARCH_KEYWORD_WEIGHT = 4.0
+SEARCH_RESULTS_PER_PAGE = 20
+
+# Collection statistics (/sentanno/stats/<collection>/) are counted
+# from stored metadata on first request and then updated on each
+# metadata write. They are recounted when older than STATS_MAX_AGE
+# seconds, to include documents added or changed outside the app. The
+# counts are kept in process memory and miss the writes of other server
+# processes until recounted.
+
+STATS_MAX_AGE = 60*60
+STATS_TOP_KEYWORDS = 50
+STATS_HOURS = 24
+
+# Store picks as judgments of the annotator (REMOTE_USER or cookie, see
+# assign.py) in addition to the document-level picks, and show each
+# annotator their own judgments, for double annotation and agreement
+# (python3 -m sentanno.agreement, /sentanno/agreement/<collection>.json).
+
+PER_ANNOTATOR_JUDGMENTS = False
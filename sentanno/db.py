@@ -1,41 +1,309 @@
 import os
+import re
+import gzip
+import lzma
 import json
+import threading
 
 from collections import OrderedDict, defaultdict
 from glob import iglob
+from types import MappingProxyType
 from tempfile import mkstemp
 
 from flask import current_app as app
 
 from sentanno import conf
+from . import metrics
+from . import search
+from . import stats
+from .cache import LRUCache
+from .singleflight import SingleFlight
 from .standoff import parse_standoff
 
 
+# Process-wide caches shared by FilesystemData instances. Listing
+# entries are validated against collection versions on each access,
+# document entries are keyed by file identity and version (see
+# FilesystemData.get_content_id()).
+
+listing_cache = LRUCache(1000)
+
+document_cache = LRUCache(1000)
+
+# Concurrent loads of the same document share one load
+
+document_flights = SingleFlight('document')
+
+
+# Locks serializing read-modify-write of document metadata, striped by
+# path: a fixed number of locks shared by all paths, so that the table
+# does not grow with the documents written. No other metadata lock is
+# taken while holding one, so paths sharing a lock cannot deadlock.
+
+METADATA_LOCK_STRIPES = 64
+
+_metadata_locks = [threading.Lock() for i in range(METADATA_LOCK_STRIPES)]
+
+
+def _metadata_lock(path):
+    return _metadata_locks[hash(path) % METADATA_LOCK_STRIPES]
+
+
+def _file_version(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+# Versions of the sets of documents in collections. Metadata files are
+# saved in the collection directory, which changes its modification
+# time; saves by this process are recorded so that they do not count as
+# changes to the documents of the collection.
+
+_collection_versions = {}    # directory -> [directory version, generation]
+
+_collection_versions_lock = threading.Lock()
+
+
+def _collection_version(collection_dir):
+    version = _file_version(collection_dir)
+    with _collection_versions_lock:
+        entry = _collection_versions.get(collection_dir)
+        if entry is None:
+            entry = _collection_versions[collection_dir] = [version, 0]
+        elif entry[0] != version:
+            entry[0] = version
+            entry[1] += 1
+        return entry[1]
+
+
+def _metadata_saved(collection_dir, before, after):
+    with _collection_versions_lock:
+        entry = _collection_versions.get(collection_dir)
+        if entry is not None and entry[0] == before:
+            entry[0] = after
+
+
+def _file_id(path):
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+# Document texts and annotations may be stored compressed as e.g.
+# <document>.txt.gz (see compress.py). The plain file is read if both
+# exist (as with precompressed variants, see conditional.py).
+
+COMPRESSION_OPENERS = OrderedDict([
+    ('.gz', gzip.open),
+    ('.xz', lzma.open),
+])
+
+
+def split_compression(name):
+    """Return (name without compression extension, compression
+    extension or '')."""
+    root, ext = os.path.splitext(name)
+    if ext in COMPRESSION_OPENERS:
+        return root, ext
+    return name, ''
+
+
+def stored_path(path):
+    """Return path, or path of compressed variant of path if only that
+    exists."""
+    if os.path.exists(path):
+        return path
+    for ext in COMPRESSION_OPENERS:
+        if os.path.exists(path+ext):
+            return path+ext
+    return path
+
+
+def read_stored_file(path):
+    """Return text of file, decompressing if path has a compression
+    extension."""
+    opener = COMPRESSION_OPENERS.get(split_compression(path)[1], open)
+    with opener(path, 'rt', encoding='utf-8') as f:
+        return f.read()
+
+
+def _natural_key(id_):
+    return [int(p) if p.isdigit() else p for p in re.split(r'(\d+)', id_)]
+
+
+def get_candidate_ids(metadata):
+    """Return ids of the candidates of a document with several
+    candidates in order, or None for a single-candidate document.
+    Judgments of the candidates of such documents are stored in the
+    metadata under candidates.<id>."""
+    candidates = metadata.get('candidates')
+    if not candidates:
+        return None
+    return sorted(candidates, key=_natural_key)
+
+
+def candidate_metadata(metadata, candidate_id):
+    """Return metadata of candidate of a multi-candidate document:
+    the document metadata updated with that of the candidate."""
+    data = { k: v for k, v in metadata.items() if k != 'candidates' }
+    data.update(metadata['candidates'][candidate_id])
+    data['candidate_id'] = candidate_id
+    return data
+
+
+def candidate_entries(metadata):
+    """Return (candidate id, metadata holding judgments) for each
+    candidate of document, with id None for single-candidate documents."""
+    ids = get_candidate_ids(metadata)
+    if ids is None:
+        return [(None, metadata)]
+    return [(i, metadata['candidates'][i]) for i in ids]
+
+
+def is_judged(metadata):
+    """Return True if all candidates of document have been accepted as
+    some option."""
+    return all(bool(m.get('accepted')) for i, m in candidate_entries(metadata))
+
+
+def document_keywords(metadata):
+    """Return processed keywords of all candidates of document."""
+    keywords = set()
+    for i, m in candidate_entries(metadata):
+        keywords.update(process_keywords(m.get('keywords') or ''))
+    return sorted(keywords)
+
+
+def annotator_metadata(metadata, annotator):
+    """Return copy of document metadata as shown to annotator: with the
+    accepted and rejected candidates and the judgment version of
+    annotator (from per-annotator judgments), without the judgments of
+    other annotators."""
+    judgment = (metadata.get('judgments') or {}).get(annotator, {})
+    data = { k: v for k, v in metadata.items() if k != 'judgments' }
+    data.update(accepted=list(judgment.get('accepted', [])),
+                rejected=list(judgment.get('rejected', [])),
+                judgment_version=judgment.get('version', 0))
+    return data
+
+
+def _judgment_sequence(judgment):
+    return judgment.get('sequence', 0)
+
+
+def _set_judgment(data, accepted, rejected, annotator=None):
+    # The document-level accepted and rejected are those of the latest
+    # judgment. Per-annotator judgments have a sequence number, as the
+    # order of keys is not kept in stored metadata, and a version of
+    # their own for detecting conflicting changes by the annotator.
+    # Cleared judgments are kept for their version.
+    if annotator is not None:
+        judgments = data.setdefault('judgments', {})
+        sequence = max(map(_judgment_sequence, judgments.values()),
+                       default=0) + 1
+        previous = judgments.get(annotator, {})
+        judgments[annotator] = {
+            'accepted': accepted,
+            'rejected': rejected,
+            'sequence': sequence,
+            'version': previous.get('version', 0) + 1,
+        }
+        judged = [j for j in judgments.values()
+                  if j['accepted'] or j['rejected']]
+        if not (accepted or rejected) and judged:
+            latest = max(judged, key=_judgment_sequence)
+            accepted, rejected = latest['accepted'], latest['rejected']
+    data['accepted'] = accepted
+    data['rejected'] = rejected
+
+
+def process_keywords(keywords):
+    """Return sorted unique lowercase keywords from comma-separated
+    keywords string."""
+    keywords = [k.lower().strip() for k in keywords.split(',')]
+    return sorted(list(set([k for k in keywords if k])))
+
+
 class DocumentData(object):
     """Text with alternative annotation sets, designated candidate
-    annotation, and possible judgments."""
-    def __init__(self, text, annsets, metadata):
-        self.text = text
-        self.annsets = annsets
-        self.metadata = metadata
-        self.candidate = self.get_annotation(self.candidate_annset,
-                                             self.candidate_id)
+    annotation, and possible judgments.
+
+    DocumentData is immutable: filtering returns a new view sharing the
+    text and annotations. Annotations must not be modified, as they can
+    be shared by any number of views and concurrent requests.
+    """
+    def __init__(self, text, annsets, metadata, candidate_id=None,
+                 filtered=False, document_metadata=None):
+        self._text = text
+        self._annsets = MappingProxyType(OrderedDict(
+            (k, tuple(v)) for k, v in annsets.items()))
+        self._metadata = MappingProxyType(dict(metadata))
+        if document_metadata is None:
+            self._document_metadata = self._metadata
+        else:
+            self._document_metadata = MappingProxyType(dict(document_metadata))
+        if candidate_id is None:
+            candidate_id = self._default_candidate_id()
+        self._candidate_id = candidate_id
+        self._candidate = self.get_annotation(self.candidate_annset,
+                                              candidate_id)
+        self._filtered = filtered
+
+    def __reduce__(self):
+        # For pickling, e.g. to pass to rendering processes
+        return (DocumentData, (self.text, dict(self.annsets),
+                               dict(self.metadata), self.candidate_id,
+                               self._filtered,
+                               dict(self.document_metadata)))
+
+    @property
+    def text(self):
+        return self._text
+
+    @property
+    def annsets(self):
+        return self._annsets
+
+    @property
+    def metadata(self):
+        """Metadata of the candidate."""
+        return self._metadata
+
+    @property
+    def document_metadata(self):
+        """Metadata of the document, same as metadata unless the
+        document has several candidates."""
+        return self._document_metadata
+
+    @property
+    def candidate_ids(self):
+        return (get_candidate_ids(self.document_metadata) or
+                [self.candidate_id])
+
+    @property
+    def multiple_candidates(self):
+        return get_candidate_ids(self.document_metadata) is not None
+
+    @property
+    def candidate(self):
+        return self._candidate
 
     def accepted_candidates(self):
-        return self.metadata.get('accepted', [])
+        return list(self.metadata.get('accepted', []))
 
     def rejected_candidates(self):
-        return self.metadata.get('rejected', [])
+        return list(self.metadata.get('rejected', []))
 
     def get_keywords(self, processed=False):
         keywords = self.metadata.get('keywords', '')
         if not processed:
             return keywords
         else:
-            keywords = [k.lower().strip() for k in keywords.split(',')]
-            keywords = sorted(list(set([k for k in keywords if k])))
-            return keywords
+            return process_keywords(keywords)
     
+    def get_document_keywords(self):
+        """Return processed keywords of all candidates of document."""
+        return document_keywords(self.document_metadata)
+
     def candidate_status(self, candidate):
         if candidate in self.accepted_candidates():
             return 'accepted'
@@ -49,14 +317,44 @@ class DocumentData(object):
                   set(self.rejected_candidates()))
         return len(judged) == 4    # TODO avoid hard-coded count
 
+    def for_annotator(self, annotator):
+        """Return view with accepted and rejected candidates of annotator
+        only."""
+        return DocumentData(self.text, self.annsets,
+                            annotator_metadata(self.metadata, annotator),
+                            self.candidate_id, self._filtered,
+                            self.document_metadata)
+
+    def for_candidate(self, candidate_id=None):
+        """Return view of identified candidate (default first) of a
+        document, sharing text and annotations."""
+        ids = get_candidate_ids(self.document_metadata)
+        if ids is None:
+            if candidate_id is not None and candidate_id != self.candidate_id:
+                raise KeyError('no candidate {}'.format(candidate_id))
+            return self
+        if candidate_id is None:
+            candidate_id = ids[0]
+        elif candidate_id not in ids:
+            raise KeyError('no candidate {}'.format(candidate_id))
+        return DocumentData(self.text, self.annsets,
+                            candidate_metadata(self.document_metadata,
+                                               candidate_id),
+                            candidate_id, self._filtered,
+                            self.document_metadata)
+
     def filter_to_candidate(self):
-        """Filter annsets to annotations overlapping candidate."""
-        filtered = { k: [] for k in self.annsets }
+        """Return view with annsets filtered to annotations overlapping
+        candidate."""
+        if self._filtered:
+            return self
+        filtered = OrderedDict((k, []) for k in self.annsets)
         for key, annset in self.annsets.items():
             for a in annset:
                 if a.overlaps(self.candidate):
                     filtered[key].append(a)
-        self.annsets = filtered
+        return DocumentData(self.text, filtered, self.metadata,
+                            self.candidate_id, True, self.document_metadata)
 
     def annotated_strings(self, unique=True, include_empty=False):
         flattened = [a for anns in self.annsets.values() for a in anns]
@@ -73,12 +371,18 @@ class DocumentData(object):
 
     @property
     def candidate_id(self):
+        return self._candidate_id
+
+    def _default_candidate_id(self):
+        ids = get_candidate_ids(self.metadata)
+        if ids is not None:
+            return ids[0]
         if 'candidate_id' not in self.metadata:
             if not self.candidate_annset:
                 raise ValueError('No candidate annotations')
             id_ = self.candidate_annset[0].id
             app.logger.warning('No candidate_id, using {}'.format(id_))
-            self.metadata['candidate_id'] = id_
+            return id_
         return self.metadata['candidate_id']
 
     @staticmethod
@@ -101,24 +405,39 @@ class FilesystemData(object):
         subdirs = []
         for name in sorted(os.listdir(self.root_dir)):
             path = os.path.join(self.root_dir, name)
-            if os.path.isdir(path):
-                subdirs.append(name)
+            if os.path.isdir(path) and not name.startswith('.'):
+                subdirs.append(name)    # hidden are e.g. ingest.OBJECTS_DIR
         return subdirs
 
     def _get_contents_by_ext(self, collection):
         """Get collection contents organized by file extension."""
-        contents_by_ext = defaultdict(list)
         collection_dir = os.path.join(self.root_dir, collection)
+        version = _collection_version(collection_dir)
+        cached = listing_cache.get(collection_dir)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        contents_by_ext = defaultdict(list)
         for name in sorted(os.listdir(collection_dir)):
             path = os.path.join(collection_dir, name)
             if os.path.isfile(path):
-                root, ext = os.path.splitext(name)
+                root, ext = os.path.splitext(split_compression(name)[0])
                 contents_by_ext[ext].append(root)
+        # shared, no defaults; plain and compressed listed once
+        contents_by_ext = {
+            ext: list(OrderedDict.fromkeys(roots))
+            for ext, roots in contents_by_ext.items()
+        }
+        listing_cache.put(collection_dir, (version, contents_by_ext))
         return contents_by_ext
 
+    def get_collection_version(self, collection):
+        """Return value that changes when documents are added to or
+        removed from collection."""
+        return _collection_version(os.path.join(self.root_dir, collection))
+
     def get_documents(self, collection, include_data=False):
         contents_by_ext = self._get_contents_by_ext(collection)
-        names = contents_by_ext['.txt']
+        names = list(contents_by_ext.get('.txt', []))
         if not include_data:            
             return names    # simple listing
         else:
@@ -127,9 +446,14 @@ class FilesystemData(object):
                 try:
                     document_data = self.get_document_data(collection, root)
                     texts.append(document_data.text)
-                    accepted.append(document_data.accepted_candidates())
-                    keywords.append(document_data.get_keywords(processed=True))
-                    if document_data.judgment_complete():
+                    metadata = document_data.document_metadata
+                    accepted.append(list(self.summarize_metadata(metadata)[1]))
+                    keywords.append(document_keywords(metadata))
+                    if document_data.multiple_candidates:
+                        complete = is_judged(metadata)
+                    else:
+                        complete = document_data.judgment_complete()
+                    if complete:
                         status = app.config['STATUS_COMPLETE']
                     else:
                         status = app.config['STATUS_INCOMPLETE']
@@ -150,40 +474,92 @@ class FilesystemData(object):
         next_doc = None if doc_idx == len(documents)-1 else documents[doc_idx+1]
         return prev_doc, next_doc
 
+    def get_document_stats(self, collection, document):
+        """Return (filename, mtime, size) for each file of document."""
+        root_path = os.path.join(self.root_dir, collection, document)
+        stats = []
+        for path in sorted(iglob(root_path + '.*')):
+            st = os.stat(path)
+            stats.append((os.path.basename(path), st.st_mtime, st.st_size))
+        if not stats:
+            raise KeyError('missing {}'.format(root_path))
+        return stats
+
+    def get_document_path(self, collection, document, ext):
+        """Return path of stored (possibly compressed) document file."""
+        return stored_path(
+            os.path.join(self.root_dir, collection, document+'.'+ext))
+
     def get_document_text(self, collection, document):
-        path = os.path.join(self.root_dir, collection, document+'.txt')
-        with open(path, encoding='utf-8') as f:
-            return f.read()
+        path = self.get_document_path(collection, document, 'txt')
+        with metrics.timed('storage'):
+            return read_stored_file(path)
 
     def get_document_annotation(self, collection, document, annset,
                                 parse=False):
-        path = os.path.join(self.root_dir, collection, document+'.'+annset)
-        with open(path, encoding='utf-8') as f:
-            data = f.read()
+        path = self.get_document_path(collection, document, annset)
+        with metrics.timed('storage'):
+            data = read_stored_file(path)
         if not parse:
             return data
         else:
-            return parse_standoff(data)
+            with metrics.timed('parse'):
+                return parse_standoff(data)
 
     def _document_metadata_path(self, collection, document):
         return os.path.join(self.root_dir, collection, document+'.json')
 
     def save_document_metadata(self, collection, document, data):
         path = self._document_metadata_path(collection, document)
+        collection_dir = os.path.dirname(path)
+        before = _file_version(collection_dir)
         self.safe_write_file(path, json.dumps(data, indent=4, sort_keys=True))
+        _metadata_saved(collection_dir, before, _file_version(collection_dir))
         
-    def get_document_metadata(self, collection, document):
+    def get_metadata_mtime(self, collection, document):
         path = self._document_metadata_path(collection, document)
-        with open(path, encoding='utf-8') as f:
-            return json.load(f)
+        return os.stat(path).st_mtime
 
-    def get_document_data(self, collection, document):
+    @staticmethod
+    def summarize_metadata(metadata):
+        """Return (judged, accepted labels, processed keywords) of
+        document metadata, as counted in collection statistics."""
+        accepted = tuple(label for i, m in candidate_entries(metadata)
+                         for label in m.get('accepted') or ())
+        keywords = tuple(document_keywords(metadata))
+        return is_judged(metadata), accepted, keywords
+
+    def get_document_metadata(self, collection, document):
+        path = self._document_metadata_path(collection, document)
+        with metrics.timed('storage'):
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+
+    def get_document_data(self, collection, document, candidate_id=None):
+        """Return DocumentData for candidate of document (default
+        first)."""
+        # Loads started before a write must not be joined after it
+        try:
+            version = (
+                self.get_content_id(collection, document),
+                _file_version(self._document_metadata_path(collection,
+                                                           document)),
+            )
+        except OSError:
+            version = None    # missing files reported by the load
+        key = (self.root_dir, collection, document, version)
+        document_data = document_flights.do(key, self._get_document_data,
+                                            collection, document)
+        return document_data.for_candidate(candidate_id)
+
+    def _get_document_data(self, collection, document):
         root_path = os.path.join(self.root_dir, collection, document)
         glob_path = root_path + '.*'
 
         extensions = set()
         for path in iglob(glob_path):
-            root, ext = os.path.splitext(os.path.basename(path))
+            name = split_compression(os.path.basename(path))[0]
+            root, ext = os.path.splitext(name)
             assert ext[0] == '.'
             ext = ext[1:]
             extensions.add(ext)
@@ -198,34 +574,180 @@ class FilesystemData(object):
             if ext not in extensions:
                 raise KeyError('missing {}.{}'.format(root_path, ext))
 
-        text = self.get_document_text(collection, document)
+        text, annotations = self._get_text_and_annotations(
+            collection, document)
         annsets = OrderedDict()
-        annsets['ann'] = self.get_document_annotation(
-            collection, document, 'ann', parse=True)
+        annsets['ann'] = annotations
         metadata = self.get_document_metadata(collection, document)
 
         return DocumentData(text, annsets, metadata)
 
-    def set_document_keywords(self, collection, document, keywords):
-        data = self.get_document_metadata(collection, document)
-        data['keywords'] = keywords
-        self.save_document_metadata(collection, document, data)
+    def get_content_version(self, collection, document):
+        """Return value that changes when document text or annotations
+        change."""
+        return tuple(
+            _file_version(self.get_document_path(collection, document, ext))
+            for ext in ('txt', 'ann')
+        )
+
+    def get_content_id(self, collection, document):
+        """Return identity and version of document text and annotation
+        files. Documents whose files are links to the same content (see
+        ingest.py) have the same content id."""
+        return tuple(
+            _file_id(self.get_document_path(collection, document, ext))
+            for ext in ('txt', 'ann')
+        )
+
+    def _get_text_and_annotations(self, collection, document):
+        """Return document text and parsed annotations, using cache."""
+        key = self.get_content_id(collection, document)
+        cached = document_cache.get(key)
+        if cached is not None:
+            text, annotations = cached
+        else:
+            text = self.get_document_text(collection, document)
+            annotations = self.get_document_annotation(
+                collection, document, 'ann', parse=True)
+            annotations = tuple(annotations)
+            document_cache.put(key, (text, annotations))
+        return text, annotations
+
+    def cache_document(self, collection, document):
+        """Load document text and annotations into the document cache."""
+        self._get_text_and_annotations(collection, document)
+
+    def get_candidate_metadata(self, collection, document, candidate_id=None):
+        """Return metadata of candidate of document (default first)."""
+        metadata = self.get_document_metadata(collection, document)
+        return self._candidate_view(metadata, candidate_id)
+
+    @staticmethod
+    def _candidate_view(metadata, candidate_id):
+        ids = get_candidate_ids(metadata)
+        if ids is None:
+            return metadata
+        return candidate_metadata(metadata, candidate_id or ids[0])
+
+    def _update_document_metadata(self, collection, document, update,
+                                  candidate_id=None):
+        """Read-modify-write document metadata. update(data) modifies
+        the data of the candidate (default first) of a multi-candidate
+        document, or the document metadata, in place and returns True if
+        it should be saved. Saving increments the version in the data.
+        Return the resulting document metadata."""
+        path = self._document_metadata_path(collection, document)
+        with _metadata_lock(path):
+            data = self.get_document_metadata(collection, document)
+            before = self.summarize_metadata(data)
+            ids = get_candidate_ids(data)
+            if ids is None:
+                target = data
+            else:
+                target = data['candidates'][candidate_id or ids[0]]
+            if update(target):
+                target['version'] = target.get('version', 0) + 1
+                self.save_document_metadata(collection, document, data)
+                stats.metadata_changed(self.root_dir, collection, before,
+                                       self.summarize_metadata(data))
+            return data
 
-    def set_document_picks(self, collection, document, accepted, rejected):
-        data = self.get_document_metadata(collection, document)
-        data['accepted'] = accepted
-        data['rejected'] = rejected
-        self.save_document_metadata(collection, document, data)
+    def set_document_keywords(self, collection, document, keywords,
+                              version=None, candidate_id=None):
+        """Save document keywords and return (keywords, version) as
+        stored. If version is given, the save is dropped unless version
+        is greater than that of the stored keywords, so that repeated
+        and out-of-order saves do not overwrite newer ones."""
+        def update(data):
+            stored = data.get('keywords_version')
+            if (version is not None and stored is not None and
+                    version <= stored):
+                metrics.inc('sentanno_stale_saves_total', field='keywords')
+                return False
+            data['keywords'] = keywords
+            if version is not None:
+                data['keywords_version'] = version
+            return True
+        data = self._update_document_metadata(collection, document, update,
+                                              candidate_id)
+        view = self._candidate_view(data, candidate_id)
+        if view.get('keywords') == keywords:
+            self._index_keywords(collection, document, data)
+        return view.get('keywords', ''), view.get('keywords_version')
+
+    def set_document_picks(self, collection, document, accepted, rejected,
+                           annotator=None, candidate_id=None):
+        """Save picks, also as the judgment of annotator if given.
+        Return the resulting metadata of the candidate."""
+        def update(data):
+            _set_judgment(data, accepted, rejected, annotator)
+            return True
+        data = self._update_document_metadata(collection, document, update,
+                                              candidate_id)
+        return self._candidate_view(data, candidate_id)
+
+    def apply_document_changes(self, collection, document, values,
+                               base_version, annotator=None,
+                               candidate_id=None,
+                               base_judgment_version=None):
+        """Set metadata fields from values if the document version is
+        base_version, i.e. the changes were made to the current
+        metadata. Return (applied, metadata), where applied is False on
+        conflict. Changes already reflected in the metadata are taken
+        as applied regardless of version. If annotator is given, picks
+        are the judgment of annotator and the returned metadata is
+        annotator_metadata(). Changes of only the picks of annotator
+        conflict only with changes of the same judgment, i.e. if its
+        version is not base_judgment_version (when given)."""
+        result = []
+        judgment_only = (annotator is not None and
+                         base_judgment_version is not None and
+                         set(values) <= {'accepted', 'rejected'})
+        def current(data):
+            if annotator is None:
+                return data
+            return annotator_metadata(data, annotator)
+        def update(data):
+            view = current(data)
+            if all(view.get(k) == v for k, v in values.items()):
+                result.append(True)
+                return False
+            if judgment_only:
+                conflict = view['judgment_version'] != base_judgment_version
+            else:
+                conflict = data.get('version', 0) != base_version
+            if conflict:
+                metrics.inc('sentanno_sync_conflicts_total')
+                result.append(False)
+                return False
+            if 'keywords' in values:
+                data['keywords'] = values['keywords']
+            if 'accepted' in values or 'rejected' in values:
+                accepted = values.get('accepted', view.get('accepted', []))
+                rejected = values.get('rejected', view.get('rejected', []))
+                _set_judgment(data, accepted, rejected, annotator)
+            result.append(True)
+            return True
+        data = self._update_document_metadata(collection, document, update,
+                                              candidate_id)
+        if result[0] and 'keywords' in values:
+            self._index_keywords(collection, document, data)
+        return result[0], current(self._candidate_view(data, candidate_id))
+
+    def _index_keywords(self, collection, document, data):
+        search.update_keywords(self.root_dir, collection, document,
+                               document_keywords(data))
 
     def safe_write_file(self, fn, text):
         """Atomic write using os.rename()."""
-        fd, tmpfn = mkstemp(dir=self.temp_dir)
-        with open(fd, 'wt') as f:
-            f.write(text)
-            # https://stackoverflow.com/a/2333979
-            f.flush()
-            os.fsync(f.fileno())
-        os.rename(tmpfn, fn)
+        with metrics.timed('write'):
+            fd, tmpfn = mkstemp(dir=self.temp_dir)
+            with open(fd, 'wt') as f:
+                f.write(text)
+                # https://stackoverflow.com/a/2333979
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpfn, fn)
 
     @staticmethod
     def read_ann(path, parse=True):
@@ -248,4 +770,8 @@ def close_db(err=None):
 
 
 def init(app):
+    listing_cache.maxsize = app.config['LISTING_CACHE_SIZE']
+    document_cache.maxsize = app.config['DOCUMENT_CACHE_SIZE']
+    metrics.register_cache('listing', listing_cache)
+    metrics.register_cache('document', document_cache)
     app.teardown_appcontext(close_db)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import Flask, render_template
+
+from .db import get_db, is_judged, process_keywords
+from .conditional import code_mtime
+from .render import RENDER_CONFIG_KEYS, picklable_config
+from .visualize import visualize_candidates, visualize_annotation_sets
+
+
+# Static HTML export of a collection: a page for each document with the
+# visualizations of its candidates and annotation sets, an index page
+# and a stylesheet shared by all pages. Documents are rendered in a pool
+# of processes, each reading its documents from the data directory.
+# The manifest records the version of each exported document so that
+# re-exports only render documents that changed.
+
+MANIFEST = 'manifest.json'
+
+STYLESHEET = 'style.css'
+
+STYLESHEET_SOURCES = ('normalize.css', 'main.css', 'visualization.css')
+
+# Configuration affecting exported pages besides RENDER_CONFIG_KEYS
+
+EXPORT_CONFIG_KEYS = ('ICON_COLORS',)
+
+# App providing config and templates in worker processes
+
+_worker_app = None
+
+_output_dir = None
+
+
+def _init_worker(config, output_dir):
+    global _worker_app, _output_dir
+    _worker_app = Flask('sentanno')
+    _worker_app.config.update(config)
+    _output_dir = output_dir
+
+
+def _write_file(path, text):
+    tmpfn = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmpfn, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmpfn, path)
+
+
+def document_summary(document_data):
+    """Return index entry of document."""
+    metadata = document_data.document_metadata
+    if document_data.multiple_candidates:
+        complete = is_judged(metadata)
+    else:
+        complete = document_data.judgment_complete()
+    return {
+        'status': 'complete' if complete else 'todo',
+        'text': document_data.text[:100],
+        'accepted': [
+            label for cid in document_data.candidate_ids for label in
+            document_data.for_candidate(cid).accepted_candidates()
+        ],
+        'keywords': document_data.get_document_keywords(),
+    }
+
+
+def export_document(task):
+    """Write page of document, return (document, summary, error)."""
+    collection, document, prev_doc, next_doc = task
+    try:
+        with _worker_app.app_context():
+            document_data = get_db().get_document_data(collection, document)
+            candidates = []
+            for candidate_id in document_data.candidate_ids:
+                data = document_data.for_candidate(candidate_id)
+                candidates.append({
+                    'id': candidate_id,
+                    'content': visualize_candidates(data),
+                    'metadata': data.metadata,
+                    'keywords': process_keywords(
+                        data.metadata.get('keywords') or ''),
+                })
+            annsets = visualize_annotation_sets(document_data,
+                                                complete_page=True)
+            html = render_template('export.html', stylesheet=STYLESHEET,
+                                   **locals())
+            summary = document_summary(document_data)
+        _write_file(os.path.join(_output_dir, document+'.html'), html)
+    except Exception as e:
+        return document, None, '{}: {}'.format(type(e).__name__, e)
+    return document, summary, None
+
+
+def _load_manifest(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _document_version(db, collection, document, neighbours):
+    stats = db.get_document_stats(collection, document)
+    return [list(s) for s in stats] + list(neighbours)
+
+
+def _write_stylesheet(app, output_dir):
+    css_dir = os.path.join(app.root_path, 'static', 'css')
+    parts = []
+    for fn in STYLESHEET_SOURCES:
+        with open(os.path.join(css_dir, fn), encoding='utf-8') as f:
+            parts.append(f.read())
+    parts.append(render_template('export.css'))
+    _write_file(os.path.join(output_dir, STYLESHEET), '\n'.join(parts))
+
+
+class Progress(object):
+    """Report documents done and throughput on a terminal."""
+    def __init__(self, total, out=sys.stderr, interval=0.5):
+        self.total = total
+        self.done = 0
+        self.out = out
+        self.interval = interval
+        self.start = self.last = time.time()
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.start
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def update(self, count=1):
+        self.done += count
+        now = time.time()
+        if (self.out.isatty() and
+                (now - self.last >= self.interval or self.done == self.total)):
+            self.last = now
+            print('\r{}/{} documents ({:.1f}/s)'.format(
+                self.done, self.total, self.rate), end='', file=self.out)
+            if self.done == self.total:
+                print(file=self.out)
+
+
+def export_collection(app, collection, output_dir, jobs=None, force=False):
+    """Export collection into output_dir, rendering documents changed
+    since the previous export (all if force is True) in jobs processes
+    (0: in this process). Return (exported, unchanged, failed)."""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST)
+    manifest = _load_manifest(manifest_path)
+    config = picklable_config(app.config)
+    with app.app_context():
+        db = get_db()
+        documents = db.get_documents(collection)
+        # repr() for comparison with the key loaded from JSON
+        config_key = [repr(code_mtime())] + [
+            repr(app.config[k]) for k in RENDER_CONFIG_KEYS +
+            EXPORT_CONFIG_KEYS]
+        previous = {}
+        if not force and manifest.get('config') == config_key:
+            previous = manifest.get('documents', {})
+        entries, tasks = {}, []
+        for i, document in enumerate(documents):
+            prev_doc = documents[i-1] if i > 0 else None
+            next_doc = documents[i+1] if i < len(documents)-1 else None
+            try:
+                version = _document_version(db, collection, document,
+                                            (prev_doc, next_doc))
+            except Exception as e:
+                app.logger.warning('Not exporting {}/{}: {}'.format(
+                    collection, document, e))
+                continue
+            entry = previous.get(document)
+            if entry is not None and entry['version'] == version:
+                entries[document] = entry
+            else:
+                entries[document] = { 'version': version }
+                tasks.append((collection, document, prev_doc, next_doc))
+        _write_stylesheet(app, output_dir)
+
+    unchanged = len(entries) - len(tasks)
+    progress = Progress(len(tasks))
+    failed = 0
+    if jobs == 0:
+        _init_worker(config, output_dir)
+        results = map(export_document, tasks)
+        executor = None
+    else:
+        context = multiprocessing.get_context(
+            app.config['RENDER_POOL_START_METHOD'])
+        if app.config['RENDER_POOL_PYTHON']:
+            context.set_executable(app.config['RENDER_POOL_PYTHON'])
+        executor = ProcessPoolExecutor(
+            jobs, mp_context=context, initializer=_init_worker,
+            initargs=(config, output_dir))
+        workers = jobs or os.cpu_count() or 1
+        chunksize = max(1, min(32, len(tasks) // (workers * 4)))
+        results = executor.map(export_document, tasks, chunksize=chunksize)
+    try:
+        for document, summary, error in results:
+            if error is not None:
+                app.logger.error('Failed to export {}/{}: {}'.format(
+                    collection, document, error))
+                del entries[document]
+                failed += 1
+            else:
+                entries[document]['summary'] = summary
+            progress.update()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for document in manifest.get('documents', {}):
+        if document not in entries:
+            try:
+                os.remove(os.path.join(output_dir, document+'.html'))
+            except FileNotFoundError:
+                pass
+
+    with app.app_context():
+        index = [(d, entries[d]['summary']) for d in documents
+                 if d in entries]
+        complete = sum(s['status'] == 'complete' for d, s in index)
+        html = render_template('exportindex.html', collection=collection,
+                               documents=index, complete=complete,
+                               stylesheet=STYLESHEET)
+    _write_file(os.path.join(output_dir, 'index.html'), html)
+    _write_file(manifest_path, json.dumps({
+        'collection': collection,
+        'config': config_key,
+        'documents': entries,
+    }, indent=1, sort_keys=True))
+
+    exported = len(tasks) - failed
+    print('{}: exported {}, unchanged {}, failed {} ({:.1f} documents/s)'
+          .format(collection, exported, unchanged, failed, progress.rate),
+          file=sys.stderr)
+    return exported, unchanged, failed
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Export collection as static HTML')
+    ap.add_argument('-d', '--datadir', default=None,
+                    help='data directory (default from config)')
+    ap.add_argument('-j', '--jobs', type=int, default=None,
+                    help='rendering processes (default CPUs, 0: none)')
+    ap.add_argument('-c', '--context', type=int, default=None,
+                    help='characters of context above and below '
+                    'candidates (default whole document)')
+    ap.add_argument('-f', '--force', default=False, action='store_true',
+                    help='export all documents, also unchanged')
+    ap.add_argument('collection')
+    ap.add_argument('outdir')
+    return ap
+
+
+def main(argv):
+    from . import create_app
+    ap = argparser()
+    args = ap.parse_args(argv[1:])
+    if args.context is not None and args.context < 1:
+        ap.error('context must be at least 1 character')
+    app = create_app()
+    if args.datadir is not None:
+        app.config['DATADIR'] = args.datadir
+    # Pages have no server to load more context from, and should not
+    # depend on how busy the rendering processes were
+    if args.context is None:
+        app.config['CONTEXT_WINDOW_CHARS'] = sys.maxsize
+    else:
+        app.config['CONTEXT_WINDOW_CHARS'] = args.context
+    app.config['CONTEXT_LOAD_CONTROLS'] = False
+    app.config['RENDER_TIME_BUDGET'] = float('inf')
+    exported, unchanged, failed = export_collection(
+        app, args.collection, args.outdir, args.jobs, args.force)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""Precompiled font advance widths for text width estimation.
+
+Run e.g. `python3 -m sentanno.fontmetrics` at build time to compile
+metrics for the fonts in static/fonts so that workers can load them
+without fontTools.
+"""
+
+import sys
+import os
+import struct
+
+from array import array
+from logging import warning
+
+
+METRICS_MAGIC = b'SAFM'
+
+METRICS_VERSION = 1
+
+METRICS_HEADER = struct.Struct('<4sHHHI')
+
+METRICS_SUFFIX = '.metrics'
+
+
+class FontMetrics(object):
+    """Glyph advance widths of a font by codepoint. Not modified after
+    creation, so instances can be shared across threads."""
+    def __init__(self, units_per_em, default_width, widths):
+        self.units_per_em = units_per_em
+        self.default_width = default_width
+        self.widths = widths
+
+    def text_width(self, text, point_size):
+        """Return width of text in given point size."""
+        widths, default = self.widths, self.default_width
+        total = sum(widths.get(ord(c), default) for c in text)
+        return total * point_size / self.units_per_em
+
+
+def metrics_path(font_path):
+    return font_path + METRICS_SUFFIX
+
+
+def compile_metrics(font_path):
+    """Read FontMetrics from font file (requires fontTools)."""
+    try:
+        from fontTools.ttLib import TTFont
+    except ImportError:
+        print('Failed `import fontTools`, try `pip3 install fonttools`',
+              file=sys.stderr)
+        raise
+    ttfont = TTFont(font_path)
+    # Following https://stackoverflow.com/a/48357457
+    tcmap = ttfont['cmap'].getcmap(3,1).cmap
+    glyphset = ttfont.getGlyphSet()
+    widths = {
+        cp: glyphset[g].width for cp, g in tcmap.items() if g in glyphset
+    }
+    return FontMetrics(ttfont['head'].unitsPerEm, glyphset['.notdef'].width,
+                       widths)
+
+
+def write_metrics(metrics, path):
+    codepoints = array('I', sorted(metrics.widths))
+    widths = array('H', (metrics.widths[c] for c in codepoints))
+    if sys.byteorder != 'little':
+        codepoints.byteswap()
+        widths.byteswap()
+    tmppath = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmppath, 'wb') as f:
+        f.write(METRICS_HEADER.pack(METRICS_MAGIC, METRICS_VERSION,
+                                    metrics.units_per_em,
+                                    metrics.default_width, len(codepoints)))
+        f.write(codepoints.tobytes())
+        f.write(widths.tobytes())
+    os.replace(tmppath, path)
+
+
+def read_metrics(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, units_per_em, default_width, count = \
+        METRICS_HEADER.unpack_from(data)
+    if magic != METRICS_MAGIC or version != METRICS_VERSION:
+        raise ValueError('{}: not a version {} metrics file'.format(
+            path, METRICS_VERSION))
+    offset = METRICS_HEADER.size
+    codepoints, widths = array('I'), array('H')
+    codepoints.frombytes(data[offset:offset+count*codepoints.itemsize])
+    offset += count*codepoints.itemsize
+    widths.frombytes(data[offset:offset+count*widths.itemsize])
+    if len(codepoints) != count or len(widths) != count:
+        raise ValueError('{}: truncated metrics file'.format(path))
+    if sys.byteorder != 'little':
+        codepoints.byteswap()
+        widths.byteswap()
+    return FontMetrics(units_per_em, default_width,
+                       dict(zip(codepoints, widths)))
+
+
+def is_stale(font_path):
+    path = metrics_path(font_path)
+    try:
+        return os.path.getmtime(path) < os.path.getmtime(font_path)
+    except OSError:
+        return True
+
+
+def load_metrics(font_path):
+    """Return FontMetrics for font, compiling and storing them if the
+    metrics file is missing or older than the font."""
+    path = metrics_path(font_path)
+    if not is_stale(font_path):
+        try:
+            return read_metrics(path)
+        except (OSError, ValueError) as e:
+            warning('failed to read {}: {}'.format(path, e))
+    warning('compiling metrics for {}'.format(font_path))
+    metrics = compile_metrics(font_path)
+    try:
+        write_metrics(metrics, path)
+    except OSError as e:
+        warning('failed to write {}: {}'.format(path, e))
+    return metrics
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Precompile font metrics')
+    ap.add_argument('-f', '--force', default=False, action='store_true',
+                    help='recompile also up-to-date metrics')
+    ap.add_argument('font', nargs='*', help='font files (default: fonts '
+                    'in static/fonts)')
+    return ap
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+    fonts = args.font
+    if not fonts:
+        fontdir = os.path.join(os.path.dirname(__file__), 'static', 'fonts')
+        fonts = [os.path.join(fontdir, fn) for fn in sorted(os.listdir(fontdir))
+                 if os.path.splitext(fn)[1].lower() in ('.ttf', '.otf')]
+    for font_path in fonts:
+        if not args.force and not is_stale(font_path):
+            print('{}: up to date'.format(font_path))
+            continue
+        metrics = compile_metrics(font_path)
+        write_metrics(metrics, metrics_path(font_path))
+        print('{}: {} glyph widths'.format(font_path, len(metrics.widths)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
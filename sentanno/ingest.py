@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import errno
+import hashlib
+
+from .db import get_db, split_compression
+
+
+# Document texts and annotations are stored by content: each distinct
+# payload is kept once in OBJECTS_DIR under its SHA-256 digest and
+# document files are hard links to it. Documents with identical
+# payloads thus have the same file identity and share parsed document
+# and visualization cache entries (see FilesystemData.get_content_id()).
+# Shared payloads are read-only; to change one, replace the document
+# file rather than editing it in place.
+
+OBJECTS_DIR = '.objects'
+
+CONTENT_EXTENSIONS = ('.txt', '.ann')
+
+_BLOCK_SIZE = 1 << 20
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def object_path(root_dir, digest):
+    return os.path.join(root_dir, OBJECTS_DIR, digest[:2], digest)
+
+
+def _link_replace(source, target):
+    """Atomically replace target with a hard link to source."""
+    temp = '{}.{}.tmp'.format(target, os.getpid())
+    os.link(source, temp)
+    try:
+        os.replace(temp, target)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+class IngestStats(object):
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.linked = 0
+        self.unique = {}    # digest -> size
+
+    def add(self, digest, size):
+        self.files += 1
+        self.bytes += size
+        self.unique[digest] = size
+
+    def update(self, other):
+        self.files += other.files
+        self.bytes += other.bytes
+        self.linked += other.linked
+        self.unique.update(other.unique)
+
+    @property
+    def unique_bytes(self):
+        return sum(self.unique.values())
+
+    def format(self, name):
+        ratio = self.bytes / self.unique_bytes if self.unique_bytes else 1.0
+        return ('{}: {} files ({} bytes), {} unique ({} bytes), '
+                'dedup ratio {:.2f}, {} linked'.format(
+                    name, self.files, self.bytes, len(self.unique),
+                    self.unique_bytes, ratio, self.linked))
+
+
+def ingest_collection(root_dir, collection, dry_run=False):
+    """Store text and annotation payloads of collection by content,
+    replacing document files with links to the stored objects. Return
+    IngestStats."""
+    stats = IngestStats()
+    directory = os.path.join(root_dir, collection)
+    for name in sorted(os.listdir(directory)):
+        ext = os.path.splitext(split_compression(name)[0])[1]
+        if ext not in CONTENT_EXTENSIONS:
+            continue
+        path = os.path.join(directory, name)
+        digest = file_digest(path)
+        st = os.stat(path)
+        stats.add(digest, st.st_size)
+        if dry_run:
+            continue
+        target = object_path(root_dir, digest)
+        try:
+            ost = os.stat(target)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.link(path, target)
+            os.chmod(target, 0o444)
+            stats.linked += 1
+            continue
+        if (ost.st_dev, ost.st_ino) == (st.st_dev, st.st_ino):
+            continue    # already ingested
+        try:
+            _link_replace(target, path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            print('{}: not on the same filesystem as {}, not linked'.format(
+                path, OBJECTS_DIR), file=sys.stderr)
+            continue
+        stats.linked += 1
+    return stats
+
+
+def prune_objects(root_dir, dry_run=False):
+    """Remove stored objects no longer linked from any document.
+    Return the number of objects removed."""
+    count = 0
+    objects_dir = os.path.join(root_dir, OBJECTS_DIR)
+    if not os.path.isdir(objects_dir):
+        return 0
+    for dirpath, dirnames, filenames in os.walk(objects_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.stat(path).st_nlink == 1:
+                if not dry_run:
+                    os.remove(path)
+                count += 1
+    return count
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Store document texts and annotations '
+                        'by content, reporting duplication')
+    ap.add_argument('-d', '--datadir', default=None,
+                    help='data directory (default from config)')
+    ap.add_argument('-n', '--dry-run', default=False, action='store_true',
+                    help='only report, do not link files')
+    ap.add_argument('-p', '--prune', default=False, action='store_true',
+                    help='remove stored objects no longer in use')
+    ap.add_argument('collection', nargs='*',
+                    help='collections to ingest (default all)')
+    return ap
+
+
+def main(argv):
+    from . import create_app
+    args = argparser().parse_args(argv[1:])
+    app = create_app()
+    if args.datadir is not None:
+        app.config['DATADIR'] = args.datadir
+    with app.app_context():
+        db = get_db()
+        root_dir = db.root_dir
+        collections = args.collection or db.get_collections()
+    total = IngestStats()
+    for collection in collections:
+        stats = ingest_collection(root_dir, collection, args.dry_run)
+        print(stats.format(collection))
+        total.update(stats)
+    if len(collections) > 1:
+        print(total.format('total'))
+    if args.prune:
+        count = prune_objects(root_dir, args.dry_run)
+        print('pruned {} unused objects'.format(count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,175 @@
+import time
+import threading
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+
+_gauges = {}
+
+_counters = defaultdict(float)
+
+_histograms = {}
+
+_caches = {}
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def inc(name, amount=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += amount
+
+
+def observe(name, value, **labels):
+    """Add observation to histogram."""
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = [[0] * (len(BUCKETS)+1), 0.0, 0]
+        histogram = _histograms[key]
+        histogram[0][bisect_left(BUCKETS, value)] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def register_cache(name, cache):
+    """Report hits, misses and size of LRUCache under name."""
+    _caches[name] = cache
+
+
+@contextmanager
+def timed(phase):
+    """Time a phase of request processing. Times of phases repeated
+    within a request are summed for the Server-Timing header."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe('sentanno_phase_seconds', elapsed, phase=phase)
+        if has_request_context():
+            timings = g.setdefault('phase_timings', {})
+            timings[phase] = timings.get(phase, 0) + elapsed
+
+
+def get_gauges():
+    with _lock:
+        return dict(_gauges)
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in items) + '}'
+
+
+def render_prometheus():
+    """Return metrics in the Prometheus text exposition format."""
+    lines = []
+    def add_family(name, type_, samples):
+        lines.append('# TYPE {} {}'.format(name, type_))
+        lines.extend(samples)
+
+    counters, gauges = get_counters(), get_gauges()
+    with _lock:
+        histograms = {k: (list(v[0]), v[1], v[2])
+                      for k, v in _histograms.items()}
+    for name, cache in sorted(_caches.items()):
+        labels = (('cache', name),)
+        counters[('sentanno_cache_hits_total', labels)] = cache.hits
+        counters[('sentanno_cache_misses_total', labels)] = cache.misses
+        gauges[('sentanno_cache_entries', labels)] = len(cache)
+        lookups = cache.hits + cache.misses
+        gauges[('sentanno_cache_hit_ratio', labels)] = (
+            cache.hits / lookups if lookups else 0)
+
+    for values, type_ in ((counters, 'counter'), (gauges, 'gauge')):
+        for name in sorted(set(n for n, l in values)):
+            add_family(name, type_, [
+                '{}{} {}'.format(name, _format_labels(l), v)
+                for (n, l), v in sorted(values.items()) if n == name
+            ])
+    for name in sorted(set(n for n, l in histograms)):
+        samples = []
+        for (n, labels), (buckets, sum_, count) in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), buckets):
+                cumulative += bucket_count
+                samples.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels, [('le', bound)]), cumulative))
+            samples.append('{}_sum{} {}'.format(
+                name, _format_labels(labels), sum_))
+            samples.append('{}_count{} {}'.format(
+                name, _format_labels(labels), count))
+        add_family(name, 'histogram', samples)
+    return '\n'.join(lines) + '\n'
+
+
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+def _add_server_timing(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    observe('sentanno_request_seconds', elapsed,
+            endpoint=request.endpoint or 'none')
+    inc('sentanno_responses_total', endpoint=request.endpoint or 'none',
+        status=response.status_code)
+    timings = g.get('phase_timings', {})
+    entries = ['{};dur={:.2f}'.format(k, v*1000) for k, v in timings.items()]
+    entries.append('total;dur={:.2f}'.format(elapsed*1000))
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+
+def init(app, start_time):
+    """Record startup time and time to first response for app created
+    at start_time."""
+    startup = time.time() - start_time
+    set_gauge('sentanno_startup_seconds', startup)
+    app.logger.info('Startup took {:.3f}s'.format(startup))
+
+    if app.config['REQUEST_TIMING']:
+        app.before_request(_start_request_timer)
+        app.after_request(_add_server_timing)
+
+    first_response = threading.Event()
+
+    @app.after_request
+    def record_first_response(response):
+        if not first_response.is_set():
+            first_response.set()
+            elapsed = time.time() - start_time
+            set_gauge('sentanno_first_response_seconds', elapsed)
+            app.logger.info('First response {:.3f}s after start'.format(
+                elapsed))
+        return response
@@ -0,0 +1,189 @@
+import os
+import re
+import io
+import json
+import time
+import random
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+from glob import glob
+from functools import partial
+
+from flask import g, request
+from flask import current_app as app
+
+from sentanno import conf
+
+
+_tracemalloc_lock = threading.Lock()
+
+_tracemalloc_users = 0
+
+
+def get_profile_dir():
+    return os.path.join(conf.get_tempdir(), 'profiles')
+
+
+def _should_profile():
+    if request.endpoint is None or request.endpoint == 'static':
+        return False
+    if app.config['PROFILE_HEADER'] in request.headers:
+        return True
+    if app.config['PROFILE_QUERY_FLAG'] in request.args:
+        return True
+    return random.random() < app.config['PROFILE_SAMPLE_RATE']
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    """Return snapshot and peak traced memory, stopping tracing if no
+    other profiled request needs it."""
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+    return snapshot, peak
+
+
+def start_profile():
+    if not _should_profile():
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError as e:
+        # Python 3.12+ allows one active profiler per process
+        app.logger.warning('Not profiling {}: {}'.format(request.path, e))
+        return
+    if app.config['PROFILE_TRACEMALLOC']:
+        _start_tracemalloc()
+        g.profile_tracemalloc = True
+    g.profile = profile
+    g.profile_start = time.perf_counter()
+
+
+def _safe_name(s):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(s))[:50]
+
+
+def finish_profile(response):
+    if 'profile' not in g:
+        return response
+    view_args = request.view_args or {}
+    info = {
+        'endpoint': request.endpoint,
+        'collection': view_args.get('collection'),
+        'document': view_args.get('document'),
+        'url': request.full_path,
+        'status': response.status_code,
+    }
+    finish = partial(
+        _save_profile, g.pop('profile'), g.pop('profile_start'),
+        g.pop('profile_tracemalloc', False), info, get_profile_dir(),
+        app.config['PROFILE_KEEP'], app.logger)
+    if response.is_streamed:
+        # Streamed pages are rendered while the response is sent
+        response.call_on_close(finish)
+    else:
+        finish()
+    return response
+
+
+def _save_profile(profile, start, traced, info, profile_dir, keep, logger):
+    # Called outside of the request context for streamed responses
+    profile.disable()
+    elapsed = time.perf_counter() - start
+    snapshot, peak = None, None
+    if traced:
+        snapshot, peak = _stop_tracemalloc()
+
+    info = dict(info, elapsed=elapsed, peak_memory=peak, time=time.time())
+    name = '-'.join(_safe_name(p) for p in (
+        time.strftime('%Y%m%d%H%M%S'), '{:06d}'.format(
+            random.randrange(10**6)),
+        info['endpoint'], info['collection'], info['document']
+    ) if p is not None)
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        base = os.path.join(profile_dir, name)
+        profile.dump_stats(base + '.prof')
+        if snapshot is not None:
+            snapshot.dump(base + '.tracemalloc')
+        with open(base + '.json', 'w') as f:
+            json.dump(info, f)
+        _remove_old_profiles(profile_dir, keep)
+    except Exception as e:
+        logger.error('Failed to save profile {}: {}'.format(name, e))
+
+
+def discard_profile(exc=None):
+    # Profiling stops here if finish_profile() was not reached, e.g.
+    # because the view raised, so the profiler does not stay enabled
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    profile.disable()
+    g.pop('profile_start', None)
+    if g.pop('profile_tracemalloc', False):
+        _stop_tracemalloc()
+
+
+def _remove_old_profiles(profile_dir, keep):
+    infos = sorted(glob(os.path.join(profile_dir, '*.json')))
+    for path in infos[:max(0, len(infos)-keep)]:
+        base = os.path.splitext(path)[0]
+        for ext in ('.json', '.prof', '.tracemalloc'):
+            try:
+                os.remove(base + ext)
+            except FileNotFoundError:
+                pass
+
+
+def get_profiles():
+    """Return info on captured profiles, slowest first."""
+    infos = []
+    for path in glob(os.path.join(get_profile_dir(), '*.json')):
+        try:
+            with open(path) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        info['name'] = os.path.splitext(os.path.basename(path))[0]
+        infos.append(info)
+    return sorted(infos, key=lambda i: i['elapsed'], reverse=True)
+
+
+def profile_summary(name, limit=40):
+    """Return text summary of profile and allocation snapshot."""
+    if not re.fullmatch(r'[A-Za-z0-9_.-]+', name):
+        raise KeyError(name)
+    base = os.path.join(get_profile_dir(), name)
+    out = io.StringIO()
+    stats = pstats.Stats(base + '.prof', stream=out)
+    stats.sort_stats('cumulative').print_stats(limit)
+    if os.path.exists(base + '.tracemalloc'):
+        snapshot = tracemalloc.Snapshot.load(base + '.tracemalloc')
+        print('Top allocations by line:', file=out)
+        for stat in snapshot.statistics('lineno')[:limit]:
+            print(stat, file=out)
+    return out.getvalue()
+
+
+def init(app):
+    if app.config['PROFILING']:
+        app.before_request(start_profile)
+        app.after_request(finish_profile)
+        app.teardown_request(discard_profile)
@@ -0,0 +1,220 @@
+import os
+import pickle
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from flask import Flask
+from flask import current_app as app
+
+from . import metrics
+from .cache import LRUCache
+from .db import get_db
+from .singleflight import SingleFlight
+from .visualize import visualize_candidates, visualize_candidates_simple
+
+
+# Pool of rendering processes, created on first use in each process
+# (not at app creation, as the app may be loaded before forking).
+
+_executor = None
+
+_executor_pid = None
+
+_executor_lock = threading.Lock()
+
+_slots = None
+
+_pending = 0
+
+_pending_lock = threading.Lock()
+
+# Visualizations by document content, candidate and configuration.
+# Documents with the same content (see ingest.py) share entries.
+
+render_cache = LRUCache(1000)
+
+# Concurrent renders of the same document share one render
+
+render_flights = SingleFlight('render')
+
+# Configuration affecting visualizations
+
+RENDER_CONFIG_KEYS = (
+    'FONT_SIZE',
+    'FONT_FILE',
+    'LINE_WIDTH',
+    'HIGHLIGHT_CONTEXT_MENTIONS',
+    'CONTEXT_WINDOW_CHARS',
+    'CONTEXT_LOAD_CONTROLS',
+    'RENDER_MAX_SPANS',
+    'RENDER_MAX_HIGHLIGHT_PATTERNS',
+    'RENDER_TIME_BUDGET',
+    'ANNOTATION_OPTIONS',
+)
+
+# App providing config to visualization code in worker processes
+
+_worker_app = None
+
+
+def _init_worker(config):
+    global _worker_app
+    _worker_app = Flask('sentanno')
+    _worker_app.config.update(config)
+
+
+def _render_in_worker(document_data, part=None):
+    with _worker_app.app_context():
+        return visualize_candidates(document_data, part)
+
+
+def picklable_config(config):
+    """Return the items of config that can be passed to other
+    processes."""
+    picklable = {}
+    for key, value in config.items():
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        picklable[key] = value
+    return picklable
+
+
+def _get_executor():
+    global _executor, _executor_pid, _slots
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            context = multiprocessing.get_context(
+                app.config['RENDER_POOL_START_METHOD'])
+            if app.config['RENDER_POOL_PYTHON']:
+                context.set_executable(app.config['RENDER_POOL_PYTHON'])
+            size = app.config['RENDER_POOL_SIZE']
+            _executor = ProcessPoolExecutor(
+                size, mp_context=context, initializer=_init_worker,
+                initargs=(picklable_config(app.config),))
+            _executor_pid = os.getpid()
+            _slots = threading.BoundedSemaphore(
+                size + app.config['RENDER_QUEUE_SIZE'])
+        return _executor, _slots
+
+
+def _reset_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def _update_pending(change):
+    global _pending
+    with _pending_lock:
+        _pending += change
+        metrics.set_gauge('sentanno_render_queue_depth', _pending)
+
+
+def render_candidates(document_data, part=None):
+    """Return visualize_candidates() for document_data, rendering in a
+    process pool if RENDER_POOL_SIZE > 0. If the pool queue is full or
+    rendering takes longer than RENDER_TIMEOUT, return a simplified
+    visualization (of all parts) instead."""
+    return _render_candidates(document_data, part)[0]
+
+
+def render_config_key(config):
+    """Return hashable values of RENDER_CONFIG_KEYS in config."""
+    return tuple(
+        tuple(v) if isinstance(v, list) else v
+        for v in (config[k] for k in RENDER_CONFIG_KEYS)
+    )
+
+
+def _cacheable(content):
+    return content, not content.get('degraded')
+
+
+def _render_candidates(document_data, part=None):
+    # Return (visualization, False if simplified or degraded by load)
+    if app.config['RENDER_POOL_SIZE'] <= 0:
+        return _cacheable(visualize_candidates(document_data, part))
+
+    executor, slots = _get_executor()
+    if not slots.acquire(blocking=False):
+        app.logger.warning('Render queue full, simplified rendering')
+        metrics.inc('sentanno_render_rejected_total')
+        return visualize_candidates_simple(document_data), False
+
+    _update_pending(1)
+    def release(future):
+        _update_pending(-1)
+        slots.release()
+    try:
+        future = executor.submit(_render_in_worker, document_data, part)
+    except Exception as e:
+        release(None)
+        app.logger.error('Failed to submit rendering: {}'.format(e))
+        if isinstance(e, BrokenProcessPool):
+            _reset_executor(executor)
+        return visualize_candidates_simple(document_data), False
+    # The slot is held until rendering finishes, also after a timeout
+    future.add_done_callback(release)
+
+    try:
+        with metrics.timed('pool'):
+            return _cacheable(
+                future.result(timeout=app.config['RENDER_TIMEOUT']))
+    except TimeoutError:
+        future.cancel()
+        app.logger.warning('Rendering timed out, simplified rendering')
+        metrics.inc('sentanno_render_timeouts_total')
+    except Exception as e:
+        app.logger.error('Rendering failed: {}'.format(e))
+        metrics.inc('sentanno_render_errors_total')
+        if isinstance(e, BrokenProcessPool):
+            _reset_executor(executor)
+    return visualize_candidates_simple(document_data), False
+
+
+def render_document(collection, document, document_data, part=None):
+    """Return render_candidates(document_data, part), cached and shared
+    with concurrent requests to render the same content. Simplified
+    visualizations and ones degraded by RENDER_TIME_BUDGET are not
+    cached."""
+    db = get_db()
+    key = (
+        db.get_content_id(collection, document), document_data.candidate_id,
+        part, render_config_key(app.config),
+    )
+    content = render_cache.get(key)
+    if content is None:
+        content, cacheable = render_flights.do(key, _render_candidates,
+                                               document_data, part)
+        if cacheable:
+            render_cache.put(key, content)
+    return content
+
+
+def init(app):
+    render_cache.maxsize = app.config['RENDER_CACHE_SIZE']
+    metrics.register_cache('render', render_cache)
+
+
+class LazyRender(object):
+    """Part of document visualization rendered with render_document() on
+    first item access. Used in streamed pages so that output preceding
+    the first use of the part is sent before rendering it. Rendering
+    time is reported as phase 'lazy_render', not in Server-Timing, as
+    the response headers have been sent by then."""
+    def __init__(self, collection, document, document_data, part=None):
+        self._args = (collection, document, document_data, part)
+        self._content = None
+
+    def __getitem__(self, key):
+        if self._content is None:
+            with metrics.timed('lazy_render'):
+                self._content = render_document(*self._args)
+        return self._content[key]
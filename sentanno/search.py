@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import sqlite3
+import threading
+
+from markupsafe import escape, Markup
+
+from flask import current_app as app
+
+from . import metrics
+
+
+# Inverted index of document texts, annotated strings and keywords in
+# SQLite FTS5 tables. Content and keywords are indexed in separate
+# tables so that keyword saves only rewrite the (small) keyword
+# postings of the document. Rows of both tables have the id of the
+# document in the documents table as rowid.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    collection TEXT NOT NULL,
+    document TEXT NOT NULL,
+    content_version TEXT,
+    UNIQUE (collection, document)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS content_index USING fts5(
+    text, strings, tokenize='unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS keyword_index USING fts5(
+    keywords, tokenize='unicode61 remove_diacritics 2'
+);
+'''
+
+# Delimiters of matches in snippets, replaced with <mark> after escaping
+
+_MATCH_START, _MATCH_END = '\x02', '\x03'
+
+_QUERY_TERM_RE = re.compile(r'"([^"]*)"|(\w+\*?)')
+
+# Connections by thread and index path
+
+_local = threading.local()
+
+
+def get_index_path(root_dir):
+    """Return path of search index for data directory root_dir, or None
+    if search is disabled."""
+    if not app.config['SEARCH_INDEX']:
+        return None
+    return os.path.join(root_dir, app.config['SEARCH_INDEX'])
+
+
+def _connect(path):
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    connection = connections.get(path)
+    if connection is None:
+        connection = sqlite3.connect(path, timeout=10)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SCHEMA)
+        connections[path] = connection
+    return connection
+
+
+def _document_id(connection, collection, document, create=False):
+    row = connection.execute(
+        'SELECT id FROM documents WHERE collection=? AND document=?',
+        (collection, document)).fetchone()
+    if row is not None:
+        return row[0]
+    elif not create:
+        return None
+    return connection.execute(
+        'INSERT INTO documents (collection, document) VALUES (?, ?)',
+        (collection, document)).lastrowid
+
+
+def _set_keywords(connection, id_, keywords):
+    connection.execute('DELETE FROM keyword_index WHERE rowid=?', (id_,))
+    if keywords:
+        connection.execute(
+            'INSERT INTO keyword_index (rowid, keywords) VALUES (?, ?)',
+            (id_, ', '.join(keywords)))
+
+
+def _delete_document(connection, id_):
+    connection.execute('DELETE FROM content_index WHERE rowid=?', (id_,))
+    connection.execute('DELETE FROM keyword_index WHERE rowid=?', (id_,))
+    connection.execute('DELETE FROM documents WHERE id=?', (id_,))
+
+
+def update_keywords(root_dir, collection, document, keywords):
+    """Replace indexed keywords of document with keywords (processed,
+    see DocumentData.get_document_keywords()). Documents not yet in the
+    index are left for index_collection(), as is creating the index."""
+    path = get_index_path(root_dir)
+    if path is None or not os.path.exists(path):
+        return
+    try:
+        with metrics.timed('search_index'):
+            connection = _connect(path)
+            with connection:
+                id_ = _document_id(connection, collection, document)
+                if id_ is not None:
+                    _set_keywords(connection, id_, keywords)
+    except sqlite3.Error as e:
+        app.logger.error('Failed to index keywords of {}/{}: {}'.format(
+            collection, document, e))
+
+
+def index_collection(db, collection, batch_size=1000):
+    """Bring index of collection up to date, (re)indexing documents
+    whose text or annotations changed since they were indexed and
+    removing documents no longer in the collection. Return the number
+    of documents (re)indexed."""
+    connection = _connect(get_index_path(db.root_dir))
+    indexed = {
+        document: (id_, version) for id_, document, version in
+        connection.execute(
+            'SELECT id, document, content_version FROM documents '
+            'WHERE collection=?', (collection,))
+    }
+    documents = db.get_documents(collection)
+    count = 0
+    try:
+        for i, document in enumerate(documents):
+            id_, indexed_version = indexed.pop(document, (None, None))
+            try:
+                version = repr(db.get_content_version(collection, document))
+                if version == indexed_version:
+                    continue
+                document_data = db.get_document_data(collection, document)
+            except Exception as e:
+                app.logger.warning('Not indexing {}/{}: {}'.format(
+                    collection, document, e))
+                continue
+            if id_ is None:
+                id_ = _document_id(connection, collection, document,
+                                   create=True)
+            else:
+                connection.execute(
+                    'DELETE FROM content_index WHERE rowid=?', (id_,))
+            connection.execute(
+                'INSERT INTO content_index (rowid, text, strings) '
+                'VALUES (?, ?, ?)',
+                (id_, document_data.text,
+                 '\n'.join(document_data.annotated_strings())))
+            _set_keywords(connection, id_,
+                          document_data.get_document_keywords())
+            connection.execute(
+                'UPDATE documents SET content_version=? WHERE id=?',
+                (version, id_))
+            count += 1
+            if count % batch_size == 0:
+                connection.commit()
+        for id_, version in indexed.values():
+            _delete_document(connection, id_)
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    return count
+
+
+def _fts_query(query):
+    """Return FTS5 query matching documents containing all words and
+    "quoted phrases" of user query (a trailing * matches prefixes), or
+    None if the query has no terms."""
+    terms = []
+    for phrase, word in _QUERY_TERM_RE.findall(query):
+        if phrase.strip():
+            terms.append('"{}"'.format(phrase.replace('"', '')))
+        elif word.endswith('*'):
+            terms.append('"{}"*'.format(word[:-1]))
+        elif word:
+            terms.append('"{}"'.format(word))
+    if not terms:
+        return None
+    return ' '.join(terms)
+
+
+def _snippet_html(snippet):
+    html = str(escape(snippet))
+    html = html.replace(_MATCH_START, '<mark>').replace(_MATCH_END, '</mark>')
+    return Markup(html)
+
+
+def search(root_dir, query, collection=None, offset=0, limit=20):
+    """Return (results, more) for documents matching query, best first.
+    Matches in document text, annotated strings and keywords are
+    ranked by BM25, with annotated strings and keywords weighted by
+    SEARCH_STRING_WEIGHT and SEARCH_KEYWORD_WEIGHT. Each result is a
+    dict with collection, document, keywords and an HTML snippet. more
+    is True if there are further results after these."""
+    path = get_index_path(root_dir)
+    fts_query = _fts_query(query)
+    if path is None or fts_query is None or not os.path.exists(path):
+        return [], False    # not built yet, see index_collection()
+    string_weight = app.config['SEARCH_STRING_WEIGHT']
+    keyword_weight = app.config['SEARCH_KEYWORD_WEIGHT']
+    connection = _connect(path)
+    # bm25() is negative, better matches lower
+    sql = '''
+        SELECT d.id, d.collection, d.document, SUM(m.score) AS score
+        FROM (
+            SELECT rowid AS id, bm25(content_index, 1.0, ?) AS score
+            FROM content_index WHERE content_index MATCH ?
+            UNION ALL
+            SELECT rowid AS id, bm25(keyword_index) * ? AS score
+            FROM keyword_index WHERE keyword_index MATCH ?
+        ) AS m JOIN documents AS d ON d.id = m.id
+        {}
+        GROUP BY d.id ORDER BY score, d.id LIMIT ? OFFSET ?
+    '''.format('WHERE d.collection = ?' if collection is not None else '')
+    params = [string_weight, fts_query, keyword_weight, fts_query]
+    if collection is not None:
+        params.append(collection)
+    params.extend([limit+1, offset])
+    with metrics.timed('search'):
+        rows = connection.execute(sql, params).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        ids = [r[0] for r in rows]
+        snippets, keywords = {}, {}
+        if ids:
+            marks = ','.join('?' * len(ids))
+            snippets = dict(connection.execute(
+                'SELECT rowid, snippet(content_index, 0, ?, ?, ?, 16) '
+                'FROM content_index WHERE content_index MATCH ? '
+                'AND rowid IN ({})'.format(marks),
+                [_MATCH_START, _MATCH_END, '...', fts_query] + ids))
+            keywords = dict(connection.execute(
+                'SELECT rowid, keywords FROM keyword_index '
+                'WHERE rowid IN ({})'.format(marks), ids))
+    results = []
+    for id_, collection_, document, score in rows:
+        snippet = snippets.get(id_)
+        results.append({
+            'collection': collection_,
+            'document': document,
+            'snippet': _snippet_html(snippet) if snippet else None,
+            'keywords': keywords[id_].split(', ') if id_ in keywords else [],
+        })
+    return results, more
+
+
+def argparser():
+    from argparse import ArgumentParser
+    ap = ArgumentParser(description='Update search index')
+    ap.add_argument('-d', '--datadir', default=None,
+                    help='data directory (default from config)')
+    ap.add_argument('collection', nargs='*',
+                    help='collections to index (default all)')
+    return ap
+
+
+def main(argv):
+    from . import create_app
+    from .db import get_db
+    args = argparser().parse_args(argv[1:])
+    app = create_app()
+    if args.datadir is not None:
+        app.config['DATADIR'] = args.datadir
+    with app.app_context():
+        db = get_db()
+        if get_index_path(db.root_dir) is None:
+            print('SEARCH_INDEX not set in config', file=sys.stderr)
+            return 1
+        for collection in args.collection or db.get_collections():
+            count = index_collection(db, collection)
+            print('{}: indexed {} documents'.format(collection, count),
+                  file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -15,7 +15,7 @@ from collections import defaultdict
 from itertools import chain
 from logging import warning
 from functools import cmp_to_key
-from cgi import escape
+from html import escape
 
 from .namespace import expand_namespace
 
@@ -453,11 +453,12 @@ def _filter_empty_spans(spans):
     return filtered
 
 
-def _standoff_to_html(text, standoffs, legend, tooltips, links):
+def _standoff_to_html(text, standoffs, legend, tooltips, links, offset=0):
     """standoff_to_html() implementation, don't invoke directly."""
 
-    # Convert standoffs to Span objects.
-    spans = [Span(so.start, so.end, so.type, so.norm) for so in standoffs]
+    # Convert standoffs to Span objects, with offsets relative to text.
+    spans = [Span(so.start-offset, so.end-offset, so.type, so.norm)
+             for so in standoffs]
 
     # Add formatting such as paragraph breaks if none are provided.
     spans = _add_formatting_spans(spans, text)
@@ -504,7 +505,7 @@ def _standoff_to_html(text, standoffs, legend, tooltips, links):
     open_span = set()
     while i < len(markers):        
         if o != markers[i].offset:
-            out.append(escape(text[o:markers[i].offset]))
+            out.append(escape(text[o:markers[i].offset], quote=False))
         o = markers[i].offset
         
         # collect markers opening or closing at this position and
@@ -557,7 +558,7 @@ def _standoff_to_html(text, standoffs, legend, tooltips, links):
             open_span.add(m.span)
                 
         i = last+1
-    out.append(escape(text[o:]))
+    out.append(escape(text[o:], quote=False))
 
     if legend_html:
         out = [legend_html] + out
@@ -601,13 +602,14 @@ def darker_color(c, amount=0.3):
 def random_colors(n, seed=None):
     import random
     import colorsys
-    
-    random.seed(seed)
-    
+
+    # Own generator to avoid reseeding the shared global one
+    rng = random.Random(seed)
+
     # based on http://stackoverflow.com/a/470747
     colors = []
     for i in range(n):
-        hsv = (1.*i/n, 0.9 + random.random()/10, 0.9 + random.random()/10)
+        hsv = (1.*i/n, 0.9 + rng.random()/10, 0.9 + rng.random()/10)
         rgb = tuple(255*x for x in colorsys.hsv_to_rgb(*hsv))
         colors.append('#%02x%02x%02x' % rgb)
     return colors
@@ -830,12 +832,17 @@ def oa_to_standoff(annotations, target_key='target'):
 
 def standoff_to_html(text, annotations, legend=False, tooltips=False,
                      links=False, complete_page=False, oa_annotations=False,
-                     embeddable=False):
-    """Create HTML representation of given text and annotations."""
+                     embeddable=False, offset=0):
+    """Create HTML representation of given text and annotations.
+
+    If offset is given, annotation offsets are taken to be relative to
+    a larger text of which text starts at offset.
+    """
     if oa_annotations:
         annotations = oa_to_standoff(annotations)
 
-    css, body = _standoff_to_html(text, annotations, legend, tooltips, links)
+    css, body = _standoff_to_html(text, annotations, legend, tooltips, links,
+                                  offset)
 
     if not complete_page:
         # Skip header, trailer and CSS for embedding
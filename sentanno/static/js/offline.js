@@ -0,0 +1,126 @@
+/* Queue of offline client changes in IndexedDB, shared by the page
+ * (sentanno.js) and the service worker (sw.js).
+ *
+ * The queue holds at most one record per document, with the latest
+ * values of changed metadata fields and the document version (and
+ * with per-annotator judgments, the judgment version) the changes were
+ * made to. Records are sent to the server in batches by
+ * syncQueue().
+ */
+
+const QUEUE_DB_NAME = "sentanno";
+const QUEUE_STORE = "changes";
+
+function openQueue() {
+    return new Promise(function(resolve, reject) {
+	var request = indexedDB.open(QUEUE_DB_NAME, 1);
+	request.onupgradeneeded = function() {
+	    request.result.createObjectStore(QUEUE_STORE, {
+		keyPath: ["collection", "document"]
+	    });
+	};
+	request.onsuccess = function() { resolve(request.result); };
+	request.onerror = function() { reject(request.error); };
+    });
+}
+
+function requestPromise(request) {
+    return new Promise(function(resolve, reject) {
+	request.onsuccess = function() { resolve(request.result); };
+	request.onerror = function() { reject(request.error); };
+    });
+}
+
+function transactionPromise(transaction) {
+    return new Promise(function(resolve, reject) {
+	transaction.oncomplete = function() { resolve(); };
+	transaction.onerror = function() { reject(transaction.error); };
+	transaction.onabort = function() { reject(transaction.error); };
+    });
+}
+
+async function enqueueChange(collection, document, baseVersion, values,
+			     baseJudgmentVersion) {
+    // merge values into any queued change for the document, keeping
+    // the version of the earliest change
+    var db = await openQueue();
+    var transaction = db.transaction(QUEUE_STORE, "readwrite");
+    var store = transaction.objectStore(QUEUE_STORE);
+    var record = await requestPromise(store.get([collection, document]));
+    if (!record) {
+	record = {
+	    collection: collection,
+	    document: document,
+	    base_version: baseVersion,
+	    base_judgment_version: baseJudgmentVersion,
+	    values: {},
+	    seq: 0
+	};
+    }
+    Object.assign(record.values, values);
+    record.seq++;
+    store.put(record);
+    await transactionPromise(transaction);
+}
+
+async function queuedChange(collection, document) {
+    var db = await openQueue();
+    var store = db.transaction(QUEUE_STORE).objectStore(QUEUE_STORE);
+    return await requestPromise(store.get([collection, document]));
+}
+
+async function syncQueue(syncUrl) {
+    // send queued changes to the server and return its results. Records
+    // changed while the request was in flight stay queued, rebased on
+    // the version the server reports.
+    var db = await openQueue();
+    var store = db.transaction(QUEUE_STORE).objectStore(QUEUE_STORE);
+    var records = await requestPromise(store.getAll());
+    if (records.length == 0) {
+	return [];
+    }
+    var changes = records.map(function(r, i) {
+	return {
+	    id: i,
+	    collection: r.collection,
+	    document: r.document,
+	    base_version: r.base_version,
+	    base_judgment_version: r.base_judgment_version,
+	    values: r.values
+	};
+    });
+    var response = await fetch(syncUrl, {
+	method: "POST",
+	headers: { "Content-Type": "application/json" },
+	body: JSON.stringify({ changes: changes })
+    });
+    var data = await response.json();
+    if (data["error"]) { throw data["message"]; }
+
+    var results = data["results"];
+    var transaction = db.transaction(QUEUE_STORE, "readwrite");
+    store = transaction.objectStore(QUEUE_STORE);
+    for (let i=0; i<results.length; i++) {
+	let result = results[i];
+	let sent = records[result["id"]];
+	result["collection"] = sent.collection;
+	result["document"] = sent.document;
+	if (result["status"] == "error") {
+	    continue;    // retry on next sync
+	}
+	let current = await requestPromise(
+	    store.get([sent.collection, sent.document]));
+	if (!current) {
+	    continue;
+	}
+	if (current.seq == sent.seq || result["status"] == "conflict") {
+	    store.delete([sent.collection, sent.document]);
+	} else {
+	    current.base_version = result["version"];
+	    current.base_judgment_version = result["judgment_version"];
+	    store.put(current);
+	}
+    }
+    await transactionPromise(transaction);
+    return results;
+}
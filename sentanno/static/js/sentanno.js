@@ -101,6 +101,9 @@ function makeUrl(url, params) {
 }
 
 async function pickCandidate(pick) {
+    if (OFFLINE_CLIENT) {
+	return await pickCandidateOffline(pick);
+    }
     var url = makeUrl(PICK_ANNO_URL, { "choice":  pick });
     spinUp();
     try {
@@ -118,33 +121,288 @@ async function pickCandidate(pick) {
     return data;
 }
 
+async function loadContext(control) {
+    if (control.disabled) {
+	return;    // already loading
+    }
+    var url = makeUrl(CONTEXT_URL, {
+	"start": control.dataset.start,
+	"end": control.dataset.end,
+	"direction": control.dataset.direction
+    });
+    control.disabled = true;
+    spinUp();
+    try {
+	var response = await fetch(url);
+	var data = await response.json();
+	if (data["error"]) { throw data["message"]; }
+	// keep the visible text in place when adding context above it
+	var height = document.documentElement.scrollHeight;
+	contextObserver.unobserve(control);
+	control.insertAdjacentHTML('afterend', data["html"]);
+	control.remove();
+	if (control.dataset.direction == "above") {
+	    window.scrollBy(0, document.documentElement.scrollHeight - height);
+	}
+	setupContextControls();
+    } catch(e) {
+	control.disabled = false;
+	updateAlert(e);
+	console.log(e);
+    }
+    spinDown();
+}
+
+// Load further context when its control scrolls into view
+var contextObserver = new IntersectionObserver(function(entries) {
+    for (let i=0; i<entries.length; i++) {
+	if (entries[i].isIntersecting) {
+	    loadContext(entries[i].target);
+	}
+    }
+}, { rootMargin: "200px" });
+
+function setupContextControls() {
+    // "load more" controls for context outside the rendered window
+    var controls = document.getElementsByClassName("pa-more");
+    for (let i=0; i<controls.length; i++) {
+	let control = controls[i];
+	control.onclick = function() {
+	    loadContext(control);
+	};
+	contextObserver.observe(control);
+    }
+}
+
+function placeContext() {
+    // move context sent after the annotation controls into place
+    var parts = ["above", "below"];
+    for (let i=0; i<parts.length; i++) {
+	let source = document.getElementById("pa-"+parts[i]+"-content");
+	document.getElementById("pa-"+parts[i]).appendChild(source.content);
+	source.remove();
+    }
+    setupContextControls();
+}
+
+// Keyword saves carry increasing versions (client timestamps) so that
+// the server can drop repeated and out-of-order saves
+var keywordsVersion = 0;
+var savedKeywords = null;
+
+function nextKeywordsVersion() {
+    keywordsVersion = Math.max(Date.now(), keywordsVersion + 1,
+			       (METADATA["keywords_version"] || 0) + 1);
+    return keywordsVersion;
+}
+
 async function saveKeywords() {
+    clearTimeout(keywordTimeout);
     var textInput = document.getElementById("keyword-input");
     var keywords = textInput.value;
-    var url = makeUrl(SAVE_KEYWORDS_URL, { "keywords":  keywords });
+    if (keywords == savedKeywords) {
+	return;
+    }
+    savedKeywords = keywords;
+    if (OFFLINE_CLIENT) {
+	await queueChange({ "keywords": keywords });
+	updateKeywords();
+	return;
+    }
+    var version = nextKeywordsVersion();
+    var url = makeUrl(SAVE_KEYWORDS_URL, {
+	"keywords": keywords,
+	"version": version
+    });
     spinUp();
     try {
-	var response = await fetch(url);
+	// keepalive: complete the save also if the user navigates away
+	var response = await fetch(url, { keepalive: true });
 	var data = await response.json();
 	if (data["error"]) { throw data["message"]; }
-	METADATA["keywords"] = data["keywords"];
-	updateKeywords();
+	if (version == keywordsVersion) {
+	    // no newer save sent in the meantime
+	    METADATA["keywords"] = data["keywords"];
+	    METADATA["keywords_version"] = data["version"];
+	    updateKeywords();
+	}
     } catch(e) {
+	savedKeywords = null;
 	updateAlert(e);
 	console.log(e);
     }
     spinDown();
 }
 
+function flushKeywords() {
+    // save pending keywords when leaving the page
+    var keywords = document.getElementById("keyword-input").value;
+    if (keywords == savedKeywords) {
+	return;
+    }
+    if (OFFLINE_CLIENT) {
+	saveKeywords();    // queued locally
+	return;
+    }
+    clearTimeout(keywordTimeout);
+    savedKeywords = keywords;
+    var data = new URLSearchParams({
+	"keywords": keywords,
+	"version": nextKeywordsVersion()
+    });
+    navigator.sendBeacon(SAVE_KEYWORDS_URL, data);
+}
+
 var keywordTimeout;    // Don't save on every keypress
 
+var KEYWORD_SAVE_DELAY = 1000;    // milliseconds without typing
+
 function keywordsChanged() {
-    var textInput = document.getElementById("keyword-input");
-    var keywords = textInput.value;
     clearTimeout(keywordTimeout);
-    keywordTimeout = setTimeout(function() {
-	saveKeywords();
-    }, 10); // , 1000); // 1sec
+    keywordTimeout = setTimeout(saveKeywords, KEYWORD_SAVE_DELAY);
+}
+
+/* offline client (OFFLINE_CLIENT in config.py): picks and keywords
+ * are applied locally, queued in IndexedDB (offline.js) and synced to
+ * the server in batches */
+
+function localPicks(pick) {
+    // as pick_annotation() in view.py
+    var candidates = document.getElementsByClassName("pa-candidate");
+    var options = [];
+    for (let i=0; i<candidates.length; i++) {
+	options.push(candidates[i].id.replace("candidate-", ""));
+    }
+    if (options.includes(pick)) {
+	return {
+	    "accepted": [pick],
+	    "rejected": options.filter(function(o) { return o != pick; })
+	};
+    } else {
+	return { "accepted": [], "rejected": [] };
+    }
+}
+
+async function pickCandidateOffline(pick) {
+    var values = localPicks(pick);
+    try {
+	await queueChange(values);
+    } catch(e) {
+	updateAlert(e);
+	console.log(e);
+    }
+    updatePicks();
+    return values;
+}
+
+async function queueChange(values) {
+    Object.assign(METADATA, values);
+    await enqueueChange(COLLECTION, DOCUMENT, METADATA["version"] || 0,
+			values, METADATA["judgment_version"]);
+    requestSync();
+}
+
+var syncTimeout;
+
+function requestSync() {
+    // sync changes made in quick succession in one batch
+    clearTimeout(syncTimeout);
+    syncTimeout = setTimeout(syncNow, 500);
+}
+
+function requestBackgroundSync() {
+    if ("serviceWorker" in navigator) {
+	navigator.serviceWorker.ready.then(function(registration) {
+	    if (registration.sync) {
+		return registration.sync.register("sentanno-sync");
+	    }
+	}).catch(function(e) { console.log(e); });
+    }
+}
+
+async function syncNow() {
+    if (!navigator.onLine) {
+	requestBackgroundSync();    // also synced when back online
+	return;
+    }
+    try {
+	handleSyncResults(await syncQueue(SYNC_URL));
+    } catch(e) {
+	console.log(e);
+	requestBackgroundSync();
+    }
+}
+
+function handleSyncResults(results) {
+    for (let i=0; i<results.length; i++) {
+	let result = results[i];
+	if (result["collection"] != COLLECTION ||
+	    result["document"] != DOCUMENT || result["status"] == "error") {
+	    continue;
+	}
+	if (result["status"] == "conflict") {
+	    // the server version wins
+	    Object.assign(METADATA, result["metadata"]);
+	    document.getElementById("keyword-input").value =
+		METADATA["keywords"] || "";
+	    savedKeywords = METADATA["keywords"] || "";
+	    updatePicks();
+	    updateKeywords();
+	    updateAlert("Changes conflicted with another save of this " +
+			"document and were discarded");
+	}
+	METADATA["version"] = result["version"];
+	METADATA["judgment_version"] = result["judgment_version"];
+    }
+}
+
+function prefetchDocuments(upcoming) {
+    if (!("serviceWorker" in navigator)) {
+	return;
+    }
+    var urls = [];
+    for (let i=0; i<upcoming.length; i++) {
+	urls.push(upcoming[i]["url"], upcoming[i]["api_url"]);
+    }
+    navigator.serviceWorker.ready.then(function(registration) {
+	registration.active.postMessage({ "type": "prefetch", "urls": urls });
+    });
+}
+
+async function loadOffline() {
+    if ("serviceWorker" in navigator) {
+	navigator.serviceWorker.register(SERVICE_WORKER_URL).catch(
+	    function(e) { console.log(e); });
+	navigator.serviceWorker.addEventListener("message", function(event) {
+	    if (event.data["type"] == "synced") {
+		handleSyncResults(event.data["results"]);
+	    }
+	});
+    }
+    window.addEventListener("online", syncNow);
+    // the page may be from the cache: get the current state from the
+    // server if possible, then apply changes not yet synced
+    try {
+	var response = await fetch(DOCUMENT_API_URL);
+	var data = await response.json();
+	if (data["error"]) { throw data["message"]; }
+	Object.assign(METADATA, data["metadata"]);
+	prefetchDocuments(data["upcoming"]);
+    } catch(e) {
+	console.log(e);
+    }
+    var queued = await queuedChange(COLLECTION, DOCUMENT);
+    if (queued) {
+	Object.assign(METADATA, queued.values);
+    }
+    var textInput = document.getElementById("keyword-input");
+    if (!textInputFocused && textInput.value == savedKeywords) {
+	textInput.value = METADATA["keywords"] || "";
+	savedKeywords = textInput.value;
+    }
+    updatePicks();
+    updateKeywords();
+    syncNow();
 }
 
 /* set up events */
@@ -203,7 +461,21 @@ function load() {
     textInput.addEventListener('input', keywordsChanged);
     textInput.addEventListener('propertychange', keywordsChanged); // IE <= 8
     textInput.addEventListener('focus', function() { textInputFocused = true });
-    textInput.addEventListener('blur', function() { textInputFocused = false });
+    textInput.addEventListener('blur', function() {
+	textInputFocused = false;
+	saveKeywords();
+    });
+    savedKeywords = textInput.value;
+    window.addEventListener('pagehide', flushKeywords);
+    document.addEventListener('visibilitychange', function() {
+	if (document.visibilityState == 'hidden') {
+	    flushKeywords();
+	}
+    });
+    setupContextControls();
     updatePicks();
     updateKeywords();
+    if (OFFLINE_CLIENT) {
+	loadOffline();
+    }
 }
@@ -0,0 +1,131 @@
+import time
+import heapq
+import threading
+
+from collections import Counter
+
+from flask import current_app as app
+
+from . import metrics
+from .singleflight import SingleFlight
+
+
+HOUR = 60*60
+
+
+def _keyword_order(item):
+    keyword, count = item
+    return -count, keyword
+
+
+class CollectionStats(object):
+    """Counters of document completion, accepted labels, keywords and
+    judgments per hour in a collection, updated with the change of each
+    metadata write. Document summaries are (judged, labels, keywords)
+    as returned by FilesystemData.summarize_metadata()."""
+    def __init__(self):
+        self.documents = 0
+        self.complete = 0
+        self.labels = Counter()
+        self.keywords = Counter()
+        self.hourly = Counter()    # judgments by hour since epoch
+        self.built = time.time()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _count(counter, key, sign):
+        # Counts falling to zero are removed, as in a recount
+        counter[key] += sign
+        if counter[key] <= 0:
+            del counter[key]
+
+    def _add(self, summary, sign):
+        judged, labels, keywords = summary
+        self.complete += sign * judged
+        for label in labels:
+            self._count(self.labels, label, sign)
+        for keyword in keywords:
+            self._count(self.keywords, keyword, sign)
+
+    def add_document(self, summary, judged_time=None):
+        with self.lock:
+            self.documents += 1
+            self._add(summary, 1)
+            if summary[0] and judged_time is not None:
+                self.hourly[int(judged_time // HOUR)] += 1
+
+    def update_document(self, before, after):
+        with self.lock:
+            self._add(before, -1)
+            self._add(after, 1)
+            if after[1] and after[1] != before[1]:
+                self.hourly[int(time.time() // HOUR)] += 1
+
+    def snapshot(self, hours=24, top_keywords=None):
+        with self.lock:
+            now = int(time.time() // HOUR)
+            return {
+                'documents': self.documents,
+                'complete': self.complete,
+                'labels': dict(self.labels),
+                'keywords': heapq.nsmallest(
+                    top_keywords or len(self.keywords),
+                    self.keywords.items(), key=_keyword_order),
+                'hourly': [
+                    (h*HOUR, self.hourly.get(h, 0))
+                    for h in range(now-hours+1, now+1)
+                ],
+                'built': self.built,
+            }
+
+
+# Counters by (data directory, collection), built on first use. Like
+# document assignment leases, these are kept in process memory, so with
+# several server processes each only sees its own writes until rebuilt.
+
+_stats = {}
+
+_stats_lock = threading.Lock()
+
+# Concurrent requests for counters being built share one build
+
+stats_flights = SingleFlight('stats')
+
+
+def build_stats(db, collection):
+    """Return CollectionStats counted from stored metadata. Documents
+    are counted as judged in the hour their metadata was last written."""
+    stats = CollectionStats()
+    for document in db.get_documents(collection):
+        try:
+            metadata = db.get_document_metadata(collection, document)
+            summary = db.summarize_metadata(metadata)
+            judged_time = db.get_metadata_mtime(collection, document)
+        except Exception as e:
+            app.logger.warning('Not counting {}/{}: {}'.format(
+                collection, document, e))
+            continue
+        stats.add_document(summary, judged_time)
+    return stats
+
+
+def get_stats(db, collection, rebuild=False):
+    """Return CollectionStats for collection, (re)building it if not
+    built, if rebuild is True or if it is older than STATS_MAX_AGE."""
+    key = (db.root_dir, collection)
+    stats = _stats.get(key)
+    if (stats is None or rebuild or
+            time.time() - stats.built > app.config['STATS_MAX_AGE']):
+        with metrics.timed('stats_build'):
+            stats = stats_flights.do(key, build_stats, db, collection)
+        with _stats_lock:
+            _stats[key] = stats
+    return stats
+
+
+def metadata_changed(root_dir, collection, before, after):
+    """Update counters of collection, if built, for metadata write
+    changing document summary from before to after."""
+    stats = _stats.get((root_dir, collection))
+    if stats is not None:
+        stats.update_document(before, after)
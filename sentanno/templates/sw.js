@@ -0,0 +1,133 @@
+/* Service worker for the offline client (OFFLINE_CLIENT in config.py).
+ *
+ * Caches static files on install and prefetches documents on request
+ * from the page. Static files and prefetched document pages are served
+ * from the cache (refreshed in the background), document states from
+ * the network when available. Queued changes are synced on background
+ * sync.
+ */
+
+importScripts({{ url_for('static', filename='js/offline.js')|tojson }});
+
+const CACHE_NAME = "sentanno-v1";
+
+const STATIC_URL = {{ url_for('static', filename='')|tojson }};
+
+const SYNC_URL = {{ url_for('view.sync_changes')|tojson }};
+
+const STATIC_FILES = [
+    {{ url_for('static', filename='css/normalize.css')|tojson }},
+    {{ url_for('static', filename='css/main.css')|tojson }},
+    {{ url_for('static', filename='css/visualization.css')|tojson }},
+    {{ url_for('static', filename='fonts/'+config['FONT_FILE'])|tojson }},
+    {{ url_for('static', filename='js/sentanno.js')|tojson }},
+    {{ url_for('static', filename='js/offline.js')|tojson }}
+];
+
+self.addEventListener("install", function(event) {
+    event.waitUntil(
+	caches.open(CACHE_NAME).then(function(cache) {
+	    return cache.addAll(STATIC_FILES);
+	}).then(function() {
+	    return self.skipWaiting();
+	})
+    );
+});
+
+self.addEventListener("activate", function(event) {
+    event.waitUntil(
+	caches.keys().then(function(names) {
+	    return Promise.all(names.filter(function(name) {
+		return name != CACHE_NAME;
+	    }).map(function(name) {
+		return caches.delete(name);
+	    }));
+	}).then(function() {
+	    return self.clients.claim();
+	})
+    );
+});
+
+async function refresh(cache, request) {
+    var response = await fetch(request);
+    if (response.ok) {
+	await cache.put(request, response.clone());
+    }
+    return response;
+}
+
+async function cachedFirst(event, store) {
+    // serve from cache if present, refreshing the cached copy in the
+    // background; otherwise fetch, caching the response if store
+    var cache = await caches.open(CACHE_NAME);
+    var cached = await cache.match(event.request);
+    if (cached) {
+	event.waitUntil(refresh(cache, event.request).catch(
+	    function(e) { console.log(e); }));
+	return cached;
+    }
+    return store ? refresh(cache, event.request) : fetch(event.request);
+}
+
+async function networkFirst(event) {
+    var cache = await caches.open(CACHE_NAME);
+    try {
+	return await refresh(cache, event.request);
+    } catch(e) {
+	var cached = await cache.match(event.request);
+	if (cached) {
+	    return cached;
+	}
+	throw e;
+    }
+}
+
+self.addEventListener("fetch", function(event) {
+    var request = event.request;
+    var url = new URL(request.url);
+    if (request.method != "GET" || url.origin != self.location.origin) {
+	return;
+    }
+    if (url.pathname.startsWith(STATIC_URL)) {
+	event.respondWith(cachedFirst(event, true));
+    } else if (url.pathname.includes("/api/")) {
+	event.respondWith(networkFirst(event));
+    } else if (request.mode == "navigate") {
+	// only prefetched documents are cached
+	event.respondWith(cachedFirst(event, false));
+    }
+});
+
+async function prefetch(urls) {
+    var cache = await caches.open(CACHE_NAME);
+    for (let i=0; i<urls.length; i++) {
+	if (!(await cache.match(urls[i]))) {
+	    try {
+		await refresh(cache, new Request(urls[i]));
+	    } catch(e) {
+		console.log(e);
+		return;    // likely offline, try again later
+	    }
+	}
+    }
+}
+
+async function syncAndNotify() {
+    var results = await syncQueue(SYNC_URL);
+    var clients = await self.clients.matchAll();
+    for (let i=0; i<clients.length; i++) {
+	clients[i].postMessage({ type: "synced", results: results });
+    }
+}
+
+self.addEventListener("message", function(event) {
+    if (event.data["type"] == "prefetch") {
+	event.waitUntil(prefetch(event.data["urls"]));
+    }
+});
+
+self.addEventListener("sync", function(event) {
+    if (event.tag == "sentanno-sync") {
+	event.waitUntil(syncAndNotify());
+    }
+});
@@ -1,9 +1,26 @@
+import io
+import os
+import time
+
 from flask import Blueprint
 from flask import request, url_for, render_template, jsonify, abort
+from flask import redirect
+from flask import make_response, send_file, stream_template
 from flask import current_app as app
+from werkzeug.wsgi import FileWrapper
 
-from .db import get_db
-from .visualize import visualize_candidates, visualize_annotation_sets
+from sentanno import conf
+from . import agreement
+from . import assign
+from . import metrics
+from . import profiling
+from . import search
+from . import stats
+from .render import render_document, LazyRender
+from .db import get_db, annotator_metadata, get_candidate_ids
+from .db import split_compression, COMPRESSION_OPENERS
+from .conditional import validated, accepts_gzip, precompressed_path
+from .visualize import visualize_annotation_sets, visualize_context
 from .config import SELECT_POSITIVE, SELECT_NEGATIVE, SELECT_NEUTRAL
 from .config import SELECT_UNCLEAR, CLEAR_SELECTION, ANNOTATION_OPTIONS
 
@@ -26,6 +43,67 @@ def show_collections():
     return render_template('collections.html', collections=collections)
 
 
+@bp.route('/search')
+def show_search():
+    query = request.args.get('q', '')
+    collection = request.args.get('collection') or None
+    page = max(request.args.get('page', type=int, default=1), 1)
+    per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+    db = get_db()
+    try:
+        results, more = search.search(db.root_dir, query, collection,
+                                      (page-1)*per_page, per_page)
+    except Exception as e:
+        app.logger.error('Search for "{}" failed: {}'.format(query, e))
+        abort(500)
+    prev_url, next_url = (
+        url_for('view.show_search', q=query, collection=collection, page=p)
+        if c else None
+        for p, c in ((page-1, page > 1), (page+1, more))
+    )
+    with metrics.timed('render'):
+        return render_template('search.html', **locals())
+
+
+def _collection_stats(collection):
+    db = get_db()
+    rebuild = bool(request.args.get('rebuild', type=int, default=0))
+    try:
+        collection_stats = stats.get_stats(db, collection, rebuild)
+    except Exception as e:
+        app.logger.error('Failed to get statistics: {}'.format(e))
+        abort(500)
+    return collection_stats.snapshot(app.config['STATS_HOURS'],
+                                     app.config['STATS_TOP_KEYWORDS'])
+
+
+@bp.route('/stats/<collection>/')
+def show_stats(collection):
+    data = _collection_stats(collection)
+    options = ANNOTATION_OPTIONS
+    with metrics.timed('render'):
+        return render_template('stats.html', collection=collection,
+                               options=options, **data)
+
+
+@bp.route('/stats/<collection>.json')
+def show_stats_data(collection):
+    return jsonify(_collection_stats(collection))
+
+
+@bp.route('/agreement/<collection>.json')
+def show_agreement(collection):
+    db = get_db()
+    try:
+        with metrics.timed('agreement'):
+            result = agreement.collection_agreement(db, collection,
+                                                    ANNOTATION_OPTIONS)
+    except Exception as e:
+        app.logger.error('Failed to compute agreement: {}'.format(e))
+        abort(500)
+    return jsonify(result)
+
+
 @bp.route('/<collection>/')
 def show_collection(collection):
     try:
@@ -35,27 +113,257 @@ def show_collection(collection):
         app.logger.error('Failed to get document data: {}'.format(e))
         abort(500)
     names, statuses, texts, accepted, keywords = docdata
-    return render_template('documents.html', **locals())
+    with metrics.timed('render'):
+        return render_template('documents.html', **locals())
+
+
+def _send_decompressed(path):
+    # Decompress while sending, validated by the stored file. Not
+    # wsgi.file_wrapper, which may send the compressed file by fileno().
+    st = os.stat(path)
+    f = COMPRESSION_OPENERS[split_compression(path)[1]](path, 'rb')
+    length = None
+    if 'Range' in request.headers:
+        # Seeking decompresses and discards, so this is slow but does
+        # not hold the file in memory
+        length = f.seek(0, io.SEEK_END)
+        f.seek(0)
+    response = app.response_class(FileWrapper(f), mimetype='text/plain',
+                                  direct_passthrough=True)
+    response.set_etag('{}-{}-decompressed'.format(st.st_mtime_ns,
+                                                  st.st_size))
+    response.last_modified = st.st_mtime
+    response.cache_control.no_cache = True
+    return response.make_conditional(request, accept_ranges=True,
+                                     complete_length=length)
+
+
+def _send_document_file(path):
+    # Serve file contents without reading them into memory, letting
+    # the front-end server send the file if so configured.
+    headers = {}
+    name, compression = split_compression(path)
+    filename = os.path.basename(name)
+    if compression == '.gz' and accepts_gzip():
+        headers['Content-Encoding'] = 'gzip'    # stored gzipped
+    elif compression:
+        response = _send_decompressed(path)
+        response.vary.add('Accept-Encoding')
+        return response
+    elif accepts_gzip():
+        gz_path = precompressed_path(path)
+        if gz_path is not None:
+            path = gz_path
+            headers['Content-Encoding'] = 'gzip'
+    prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    datadir = os.path.abspath(conf.get_datadir())
+    if prefix and os.path.abspath(path).startswith(datadir + os.sep):
+        relpath = os.path.relpath(path, datadir)
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = '/'.join(
+            [prefix.rstrip('/')] + relpath.split(os.sep))
+    else:
+        response = send_file(path, mimetype='text/plain', conditional=True,
+                             download_name=filename)
+    response.mimetype = 'text/plain'
+    response.headers.update(headers)
+    response.vary.add('Accept-Encoding')
+    return response
 
 
 @bp.route('/<collection>/<document>.txt')
 def show_text(collection, document):
     db = get_db()
-    return db.get_document_text(collection, document)
+    path = db.get_document_path(collection, document, 'txt')
+    return _send_document_file(path)
 
 
 @bp.route('/<collection>/<document>.ann<idx>')
 def show_annotation_set(collection, document, idx):
     db = get_db()
-    return db.get_document_annotation(collection, document, 'ann'+idx)
+    path = db.get_document_path(collection, document, 'ann'+idx)
+    return _send_document_file(path)
 
 
 @bp.route('/<collection>/<document>.json')
+@validated()
 def show_metadata(collection, document):
     db = get_db()
     return jsonify(db.get_document_metadata(collection, document))
 
 
+def _judging_annotator():
+    # annotator whose own judgments are shown and saved, if any
+    if app.config['PER_ANNOTATOR_JUDGMENTS']:
+        return assign.get_annotator()
+    return None
+
+
+def _split_document_key(key):
+    # "<document>/<candidate_id>" identifies a candidate of a document
+    # with several, see _document_key()
+    document, _, candidate_id = key.partition('/')
+    return document, candidate_id or None
+
+
+def _document_key(document, candidate_id):
+    if candidate_id is None:
+        return document
+    return '{}/{}'.format(document, candidate_id)
+
+
+@bp.route('/api/<collection>/<document>', defaults={'candidate_id': None})
+@bp.route('/api/<collection>/<document>/<candidate_id>')
+def show_document_state(collection, document, candidate_id):
+    """Document metadata and version for the offline client, with the
+    URLs of upcoming documents to cache."""
+    db = get_db()
+    try:
+        metadata = db.get_candidate_metadata(collection, document,
+                                             candidate_id)
+        documents = db.get_documents(collection)
+        index = documents.index(document)
+        annotator = _judging_annotator()
+        if annotator is not None:
+            metadata = annotator_metadata(metadata, annotator)
+    except Exception as e:
+        app.logger.error('Failed to get state of {}/{}: {}'.format(
+            collection, document, e))
+        return jsonify({
+            'error': True,
+            'message': 'No document {}/{}'.format(collection, document)
+        })
+    count = request.args.get('upcoming', type=int,
+                             default=app.config['OFFLINE_PREFETCH_DOCUMENTS'])
+    upcoming = documents[index+1:index+1+max(count, 0)]
+    return jsonify({
+        'collection': collection,
+        'document': document,
+        'metadata': metadata,
+        'version': metadata.get('version', 0),
+        'upcoming': [
+            {
+                'document': d,
+                'url': url_for('view.show_annotation', collection=collection,
+                               document=d),
+                'api_url': url_for('view.show_document_state',
+                                   collection=collection, document=d),
+            }
+            for d in upcoming
+        ],
+    })
+
+
+SYNC_FIELDS = ('accepted', 'rejected', 'keywords')
+
+
+@bp.route('/sync', methods=['POST'])
+def sync_changes():
+    """Apply batch of queued offline client changes. Each change has
+    an id, collection, document (or "<document>/<candidate_id>"), the
+    base_version of the document the change was made to, and values
+    for SYNC_FIELDS. With PER_ANNOTATOR_JUDGMENTS, changes also have
+    the base_judgment_version of the judgment of the annotator."""
+    db = get_db()
+    data = request.get_json(silent=True)
+    changes = data.get('changes') if isinstance(data, dict) else None
+    if not isinstance(changes, list):
+        return jsonify({
+            'error': True,
+            'message': 'Invalid sync request'
+        })
+    annotator = _judging_annotator()
+    results = []
+    for change in changes:
+        if not isinstance(change, dict):
+            change = {}
+        result = { 'id': change.get('id') }
+        try:
+            values = { k: v for k, v in change['values'].items()
+                       if k in SYNC_FIELDS }
+            document, candidate_id = _split_document_key(change['document'])
+            applied, metadata = db.apply_document_changes(
+                change['collection'], document, values,
+                change['base_version'], annotator, candidate_id,
+                change.get('base_judgment_version'))
+        except Exception as e:
+            app.logger.error('Failed to sync change: {}'.format(e))
+            result['status'] = 'error'
+        else:
+            result['status'] = 'applied' if applied else 'conflict'
+            assign.document_updated(change['collection'], document)
+            result['metadata'] = metadata
+            result['version'] = metadata.get('version', 0)
+            if annotator is not None:
+                result['judgment_version'] = metadata['judgment_version']
+        results.append(result)
+    app.logger.info('Synced {} changes'.format(len(results)))
+    return jsonify({
+        'results': results
+    })
+
+
+@bp.route('/assign/<collection>/next')
+def next_assigned(collection):
+    """Redirect to the document leased to the requesting annotator,
+    leasing the next free one if needed (or if skip is given)."""
+    if not app.config['ASSIGNMENT']:
+        abort(404)
+    try:
+        scheduler = assign.get_scheduler(collection)
+    except Exception as e:
+        app.logger.error('Failed to get documents: {}'.format(e))
+        abort(500)
+    skip = bool(request.args.get('skip', type=int, default=0))
+    document = scheduler.assign(assign.get_annotator(), skip_current=skip)
+    if document is None:
+        app.logger.info('{}: no documents to assign'.format(collection))
+        return redirect(url_for('view.show_collection', collection=collection))
+    return redirect(url_for('view.show_annotation', collection=collection,
+                            document=document))
+
+
+@bp.route('/assign/<collection>/')
+def show_assignment_status(collection):
+    if not app.config['ASSIGNMENT']:
+        abort(404)
+    return jsonify(assign.get_scheduler(collection).status())
+
+
+@bp.route('/sw.js')
+def service_worker():
+    response = make_response(render_template('sw.js'))
+    response.mimetype = 'application/javascript'
+    response.cache_control.no_cache = True
+    return response
+
+
+@bp.route('/metrics')
+def show_metrics():
+    response = make_response(metrics.render_prometheus())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] += '; version=0.0.4'
+    return response
+
+
+@bp.route('/profiles/')
+def show_profiles():
+    profiles = profiling.get_profiles()
+    return render_template('profiles.html', profiles=profiles)
+
+
+@bp.route('/profiles/<name>')
+def show_profile(name):
+    try:
+        summary = profiling.profile_summary(name)
+    except (KeyError, OSError) as e:
+        app.logger.error('Failed to read profile {}: {}'.format(name, e))
+        abort(404)
+    response = make_response(summary)
+    response.mimetype = 'text/plain'
+    return response
+
+
 def _prev_and_next_url(endpoint, collection, document):
     # navigation helper
     db = get_db()
@@ -69,40 +377,170 @@ def _prev_and_next_url(endpoint, collection, document):
 
 
 @bp.route('/<collection>/<document>.all')
+@validated(neighbours=True)
 def show_all_annotations(collection, document):
     db = get_db()
     document_data = db.get_document_data(collection, document)
     content = visualize_annotation_sets(document_data)
     prev_url, next_url = _prev_and_next_url(
         request.endpoint, collection, document)
-    return render_template('annsets.html', **locals())
+    with metrics.timed('render'):
+        return render_template('annsets.html', **locals())
 
 
-@bp.route('/<collection>/<document>')
-def show_annotation(collection, document):
+def _join_until_flush(chunks):
+    """Join streamed template output into chunks ending at `{{ flush }}`
+    (empty output) in the template."""
+    buffer = []
+    for chunk in chunks:
+        if chunk:
+            buffer.append(chunk)
+        elif buffer:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+
+
+def _last_candidate_id(collection, document):
     db = get_db()
-    document_data = db.get_document_data(collection, document)
+    try:
+        metadata = db.get_document_metadata(collection, document)
+    except Exception:
+        return None    # let the view deal with it
+    ids = get_candidate_ids(metadata)
+    return ids[-1] if ids else None
+
+
+def _candidate_prev_and_next_url(collection, document, document_data):
+    # navigation helper stepping through the candidates of a document
+    # before moving to the previous or next document
+    db = get_db()
+    prev_doc, next_doc = db.get_neighbouring_documents(collection, document)
+    ids = document_data.candidate_ids
+    index = ids.index(document_data.candidate_id)
+    def candidate_url(document, candidate_id=None):
+        return url_for('view.show_annotation', collection=collection,
+                       document=document, candidate_id=candidate_id)
+    if index > 0:
+        prev_url = candidate_url(document, ids[index-1])
+    elif prev_doc is not None:
+        prev_url = candidate_url(prev_doc,
+                                 _last_candidate_id(collection, prev_doc))
+    else:
+        prev_url = None
+    if index < len(ids)-1:
+        next_url = candidate_url(document, ids[index+1])
+    elif next_doc is not None:
+        next_url = candidate_url(next_doc)
+    else:
+        next_url = None
+    return prev_url, next_url, index < len(ids)-1
+
+
+@bp.route('/<collection>/<document>', defaults={'candidate_id': None})
+@bp.route('/<collection>/<document>/<candidate_id>')
+@validated(neighbours=True, per_annotator=True, leased=True)
+def show_annotation(collection, document, candidate_id):
+    db = get_db()
+    try:
+        document_data = db.get_document_data(collection, document,
+                                             candidate_id)
+    except KeyError as e:
+        app.logger.error('Failed to get document data: {}'.format(e))
+        abort(404)
     # Filter to avoid irrelevant types in legend
-    document_data.filter_to_candidate()
-    metadata = document_data.metadata
-    content = visualize_candidates(document_data)
-    prev_url, next_url = _prev_and_next_url(
-        request.endpoint, collection, document)
+    document_data = document_data.filter_to_candidate()
+    annotator = _judging_annotator()
+    if annotator is not None:
+        document_data = document_data.for_annotator(annotator)
+    metadata = dict(document_data.metadata,
+                    candidate_id=document_data.candidate_id)
+    if document_data.multiple_candidates:
+        candidate_id = document_data.candidate_id
+        candidate_index = document_data.candidate_ids.index(candidate_id)
+    else:
+        candidate_id = None
+    document_key = _document_key(document, candidate_id)
+    prev_url, next_url, next_in_document = _candidate_prev_and_next_url(
+        collection, document, document_data)
+    if app.config['ASSIGNMENT']:
+        assign.renew_lease(collection, document)
+        if not next_in_document:
+            next_url = url_for('view.next_assigned', collection=collection,
+                               skip=1)
     options = ANNOTATION_OPTIONS
     status = [document_data.candidate_status(i) for i in options]
     keywords = document_data.get_keywords()
-    return render_template('sentanno.html', **locals())
+    if app.config['STREAM_PAGES']:
+        # The candidate line is rendered before the response starts, so
+        # that its time is in Server-Timing, and the context when the
+        # template reaches it, after the controls have been sent
+        with metrics.timed('render'):
+            content = render_document(collection, document, document_data,
+                                      'line')
+        context = LazyRender(collection, document, document_data,
+                             'context')
+        return _join_until_flush(stream_template('sentanno.html', **locals()))
+    content = context = render_document(collection, document, document_data)
+    with metrics.timed('render'):
+        return render_template('sentanno.html', **locals())
 
 
-@bp.route('/<collection>/<document>/keywords')
-def save_keywords(collection, document):
+@bp.route('/<collection>/<document>/context', defaults={'candidate_id': None})
+@bp.route('/<collection>/<document>/<candidate_id>/context')
+@validated()
+def show_context(collection, document, candidate_id):
     db = get_db()
-    document_data = db.get_document_data(collection, document)
-    keywords = request.args.get('keywords')
-    app.logger.info('{}/{}: keywords "{}"'.format(
-        collection, document, keywords))
     try:
-        db.set_document_keywords(collection, document, keywords)
+        document_data = db.get_document_data(collection, document,
+                                             candidate_id)
+    except KeyError as e:
+        app.logger.error('Failed to get document data: {}'.format(e))
+        abort(404)
+    document_data = document_data.filter_to_candidate()
+    text = document_data.text
+    direction = request.args.get('direction')
+    try:
+        start = int(request.args.get('start'))
+        end = int(request.args.get('end'))
+    except (TypeError, ValueError):
+        start, end = None, None
+    if (direction not in ('above', 'below') or start is None or
+        not 0 <= start <= end <= len(text)):
+        return jsonify({
+            'error': True,
+            'message': 'Invalid context range'
+        })
+    if app.config['HIGHLIGHT_CONTEXT_MENTIONS']:
+        annsets = document_data.annsets
+    else:
+        annsets = None
+    deadline = time.perf_counter() + app.config['RENDER_TIME_BUDGET']
+    with metrics.timed('html'):
+        html = visualize_context(text, start, end, direction, annsets,
+                                 deadline)
+    return jsonify({
+        'html': html
+    })
+
+
+@bp.route('/<collection>/<document>/keywords', methods=['GET', 'POST'],
+          defaults={'candidate_id': None})
+@bp.route('/<collection>/<document>/<candidate_id>/keywords',
+          methods=['GET', 'POST'])
+def save_keywords(collection, document, candidate_id):
+    # POST is for navigator.sendBeacon() when leaving the page
+    db = get_db()
+    keywords = request.values.get('keywords')
+    version = request.values.get('version', type=int)
+    app.logger.info('{}: keywords "{}" (version {})'.format(
+        _document_key(collection+'/'+document, candidate_id), keywords,
+        version))
+    assign.renew_lease(collection, document)
+    try:
+        keywords, version = db.set_document_keywords(
+            collection, document, keywords, version, candidate_id)
     except Exception as e:
         app.logger.error('Failed to save keywords: {}'.format(e))
         return jsonify({
@@ -111,14 +549,16 @@ def save_keywords(collection, document):
         })
     else:
         return jsonify({
-            'keywords': keywords
+            'keywords': keywords,
+            'version': version,
         })
 
 
-@bp.route('/<collection>/<document>/pick')
-def pick_annotation(collection, document):
+@bp.route('/<collection>/<document>/pick', defaults={'candidate_id': None})
+@bp.route('/<collection>/<document>/<candidate_id>/pick')
+def pick_annotation(collection, document, candidate_id):
     db = get_db()
-    document_data = db.get_document_data(collection, document)
+    document_data = db.get_document_data(collection, document, candidate_id)
     choice = request.args.get('choice')
     options = ANNOTATION_OPTIONS
     if choice in options:
@@ -132,11 +572,14 @@ def pick_annotation(collection, document):
         accepted = []
         rejected = []
 
-    app.logger.info('{}/{}: accepted {}, rejected {}'.format(
-        collection, document, accepted, rejected))
+    app.logger.info('{}: accepted {}, rejected {}'.format(
+        _document_key(collection+'/'+document, candidate_id), accepted,
+        rejected))
 
+    annotator = _judging_annotator()
     try:
-        db.set_document_picks(collection, document, accepted, rejected)
+        db.set_document_picks(collection, document, accepted, rejected,
+                              annotator, candidate_id)
     except Exception as e:
         app.logger.error('Failed to set picks: {}'.format(e))
         return jsonify({
@@ -145,7 +588,11 @@ def pick_annotation(collection, document):
         })
     else:
         # Read back to confirm the DB agrees
-        data = db.get_document_metadata(collection, document)
+        data = db.get_candidate_metadata(collection, document, candidate_id)
+        assign.document_updated(collection, document)
+        assign.renew_lease(collection, document)
+        if annotator is not None:
+            data = annotator_metadata(data, annotator)
         return jsonify({
             'accepted': data['accepted'],
             'rejected': data['rejected'],
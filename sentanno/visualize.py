@@ -1,21 +1,18 @@
 import os
-import sys
 import re
+import time
+import threading
+
+from html import escape
 
 from itertools import chain
 
 from flask import current_app as app
 
 from sentanno import conf
+from . import metrics
 from .so2html import standoff_to_html, generate_legend
-
-
-try:
-    from fontTools.ttLib import TTFont
-except ImportError:
-    print('Failed `import fontTools`, try `pip3 install fonttools`',
-          file=sys.stderr)
-    raise
+from .fontmetrics import load_metrics
 
 
 def visualize_legend(document_data):
@@ -24,11 +21,16 @@ def visualize_legend(document_data):
     return generate_legend(types, include_style=True)
 
 
-def visualize_annotation_sets(document_data):
-    """Generate visualization of several annotation sets for the same text."""
+def visualize_annotation_sets(document_data, complete_page=False):
+    """Generate visualization of several annotation sets for the same text.
+    If complete_page is True, each visualization includes its own CSS
+    (for pages without visualization.css, see export.py)."""
     text = document_data.text
     annsets = document_data.annsets
-    return [(k, standoff_to_html(text, a)) for k, a in annsets.items()]
+    with metrics.timed('html'):
+        return [(k, standoff_to_html(text, a, complete_page=complete_page,
+                                     embeddable=complete_page))
+                for k, a in annsets.items()]
 
 
 def _find_covering_span(text, annsets, word_boundary=True):
@@ -46,65 +48,272 @@ def _find_covering_span(text, annsets, word_boundary=True):
     return start, end
 
 
-def visualize_candidates(document_data):
-    """Generate visualization of alternative annotation candidates."""
-    text = document_data.text
-    data = document_data.metadata
+class _BudgetExceeded(Exception):
+    pass
+
 
-    # Filter all annotation sets to overlapping (note: destructive)
-    document_data.filter_to_candidate()
+def _check_budget(annsets):
+    """Return description of exceeded render budget limit, None if the
+    document is within budget."""
+    spans = sum(len(anns) for anns in annsets.values())
+    if spans > app.config['RENDER_MAX_SPANS']:
+        return '{} spans'.format(spans)
+    if app.config['HIGHLIGHT_CONTEXT_MENTIONS']:
+        patterns = len(set(
+            a.text for anns in annsets.values() for a in anns if a.text))
+        if patterns > app.config['RENDER_MAX_HIGHLIGHT_PATTERNS']:
+            return '{} highlight patterns'.format(patterns)
+    return None
+
+
+def visualize_candidates(document_data, part=None):
+    """Generate visualization of alternative annotation candidates.
+
+    Context above and below the candidate line is limited to
+    CONTEXT_WINDOW_CHARS characters each, see visualize_context().
+    Documents exceeding the render budget (RENDER_MAX_* and
+    RENDER_TIME_BUDGET) get a cheaper layout, see
+    _visualize_candidates_degraded(). 'degraded' in the result is True
+    if RENDER_TIME_BUDGET ran out, so that the result depends on load.
+    part 'line' only generates the candidate line (left, spans and
+    right) and 'context' only the context (above and below).
+    """
+    # Filter all annotation sets to overlapping (no-op if filtered)
+    document_data = document_data.filter_to_candidate()
+    text = document_data.text
     annsets = document_data.annsets
+    deadline = time.perf_counter() + app.config['RENDER_TIME_BUDGET']
 
-    # Identify span to center in the visualization
-    span_start, span_end = _find_covering_span(text, annsets)
+    with metrics.timed('layout'):
+        # Identify span to center in the visualization
+        span_start, span_end = _find_covering_span(text, annsets)
 
-    # Split text to segments around centered span
-    above, left, span, right, below = _split_text(text, span_start, span_end)
+        reason = _check_budget(annsets)
+        if reason is None:
+            # Split text to segments around centered span
+            above, left, span, right, below = _split_text(
+                text, span_start, span_end)
 
-    # Adjust offsets for filtered annotations to zero at centered span start
-    annsets = _adjust_offsets(annsets, span_start)
+            if not app.config['HIGHLIGHT_CONTEXT_MENTIONS']:
+                highlight, left_ann, right_ann = None, [], []
+            else:
+                # TODO annotations spanning boundaries (e.g. above-left)
+                highlight, left_ann, right_ann = annsets, [], []
+            if highlight is not None and part != 'context':
+                try:
+                    left_ann, right_ann = (
+                        _add_highlight_annotations(
+                            t, annsets, deadline,
+                            app.config['RENDER_MAX_SPANS'])
+                        for t in (left, right)
+                    )
+                except _BudgetExceeded as e:
+                    reason = str(e)
+
+    if reason is not None:
+        app.logger.warning('Render budget exceeded ({}), degraded '
+                           'layout'.format(reason))
+        metrics.inc('sentanno_render_degraded_total')
+        return _visualize_candidates_degraded(
+            text, annsets, span_start, span_end, deadline, part)
 
-    if not app.config['HIGHLIGHT_CONTEXT_MENTIONS']:
-        above_ann, left_ann, right_ann, below_ann = [], [], [], []
-    else:
-        # TODO annotations spanning boundaries (e.g. above-left)
-        above_ann, left_ann, right_ann, below_ann = (
-            _add_highlight_annotations(t, annsets)
-            for t in (above, left, right, below)
-        )
+    so2html = standoff_to_html
+    below_start = len(text) - len(below)
+    content = {}
+    with metrics.timed('html'):
+        if part != 'context':
+            # Annotation offsets are relative to the centered span start
+            content.update({
+                'left': so2html(left, left_ann),
+                'spans': { k: so2html(span, a, offset=span_start)
+                           for k, a in annsets.items() },
+                'right': so2html(right, right_ann),
+            })
+        if part != 'line':
+            content.update({
+                'above': visualize_context(text, 0, len(above), 'above',
+                                           highlight, deadline),
+                'below': visualize_context(text, below_start, len(text),
+                                           'below', highlight, deadline),
+            })
+    content['degraded'] = time.perf_counter() > deadline
+    return content
+
+
+def _visualize_candidates_degraded(text, annsets, span_start, span_end,
+                                   deadline, part=None):
+    """Generate visualization with bounded work: highlighting only on
+    the candidate line, for at most RENDER_MAX_HIGHLIGHT_PATTERNS
+    strings, and at most RENDER_MAX_SPANS spans per annotation set."""
+    max_spans = app.config['RENDER_MAX_SPANS']
+    max_patterns = app.config['RENDER_MAX_HIGHLIGHT_PATTERNS']
+
+    with metrics.timed('layout'):
+        above, left, span, right, below = _split_text(
+            text, span_start, span_end)
+        left_ann, right_ann = [], []
+        if app.config['HIGHLIGHT_CONTEXT_MENTIONS'] and part != 'context':
+            try:
+                left_ann, right_ann = (
+                    _add_highlight_annotations(t, annsets, deadline,
+                                               max_spans, max_patterns)
+                    for t in (left, right)
+                )
+            except _BudgetExceeded:
+                left_ann, right_ann = [], []
 
     so2html = standoff_to_html
+    below_start = len(text) - len(below)
+    content = {}
+    with metrics.timed('html'):
+        if part != 'context':
+            content.update({
+                'left': so2html(left, left_ann),
+                'spans': { k: so2html(span, a[:max_spans],
+                                      offset=span_start)
+                           for k, a in annsets.items() },
+                'right': so2html(right, right_ann),
+            })
+        if part != 'line':
+            content.update({
+                'above': visualize_context(text, 0, len(above), 'above'),
+                'below': visualize_context(text, below_start, len(text),
+                                           'below'),
+            })
+    content['degraded'] = time.perf_counter() > deadline
+    return content
+
+
+def _context_control(start, end, direction):
+    if start >= end:
+        return ''
+    if not app.config['CONTEXT_LOAD_CONTROLS']:
+        return ('<span class="pa-omitted">&hellip; {} more characters'
+                '</span>'.format(end-start))
+    return ('<button class="pa-more" data-start="{}" data-end="{}" '
+            'data-direction="{}">&hellip; {} more characters</button>'.format(
+                start, end, direction, end-start))
+
+
+def _context_chunk(text, start, end, direction):
+    """Return (start, end) of the at most CONTEXT_WINDOW_CHARS
+    characters of text[start:end] nearest to the candidate, ending at a
+    line or word boundary where possible. The chunk is never empty if
+    the range is not, as the client would request the same range again
+    for an empty chunk."""
+    limit = max(1, app.config['CONTEXT_WINDOW_CHARS'])
+    if direction == 'above':
+        chunk_start = max(start, end-limit)
+        if chunk_start > start:
+            for boundary in ('\n', ' '):
+                index = text.find(boundary, chunk_start, end)
+                if index != -1 and index + 1 < end:
+                    chunk_start = index + 1
+                    break
+        return chunk_start, end
+    else:
+        chunk_end = min(end, start+limit)
+        if chunk_end < end:
+            for boundary in ('\n', ' '):
+                index = text.rfind(boundary, start, chunk_end)
+                if index > start:
+                    chunk_end = index + 1
+                    break
+        return start, chunk_end
+
+
+def visualize_context(text, start, end, direction, annsets=None,
+                      deadline=None):
+    """Generate visualization of the chunk of text[start:end] nearest
+    to the candidate, i.e. at the end of the range for direction
+    'above' and at its start for 'below', with a control for loading
+    the rest of the range. If annsets is given, highlight mentions of
+    their annotated strings in the chunk, unless this exceeds the
+    render budget."""
+    chunk_start, chunk_end = _context_chunk(text, start, end, direction)
+    assert chunk_start < chunk_end or start >= end, 'empty context chunk'
+    chunk = text[chunk_start:chunk_end]
+    highlights = []
+    if annsets is not None:
+        try:
+            highlights = _add_highlight_annotations(
+                chunk, annsets, deadline, app.config['RENDER_MAX_SPANS'],
+                app.config['RENDER_MAX_HIGHLIGHT_PATTERNS'])
+        except _BudgetExceeded as e:
+            app.logger.warning('Not highlighting context: {}'.format(e))
+    html = standoff_to_html(chunk, highlights)
+    if direction == 'above':
+        return _context_control(start, chunk_start, direction) + html
+    else:
+        return html + _context_control(chunk_end, end, direction)
+
+
+def _escape_context(text):
+    return escape(text).replace('\n', '<br/>\n')
+
+
+def _visualize_context_simple(text, start, end, direction):
+    # visualize_context() without highlighting or standoff_to_html()
+    chunk_start, chunk_end = _context_chunk(text, start, end, direction)
+    html = _escape_context(text[chunk_start:chunk_end])
+    if direction == 'above':
+        return _context_control(start, chunk_start, direction) + html
+    else:
+        return html + _context_control(chunk_end, end, direction)
+
+
+def visualize_candidates_simple(document_data, max_line_context=200):
+    """Generate cheap visualization of annotation candidates: plain
+    escaped context, limited as in visualize_context(), and the
+    candidate line split at newlines."""
+    document_data = document_data.filter_to_candidate()
+    text = document_data.text
+    annsets = document_data.annsets
+
+    span_start, span_end = _find_covering_span(text, annsets)
+    line_start = text.rfind('\n', 0, span_start) + 1
+    line_start = max(line_start, span_start - max_line_context)
+    line_end = text.find('\n', span_end)
+    if line_end == -1:
+        line_end = len(text)
+    line_end = min(line_end, span_end + max_line_context)
+
+    span = text[span_start:span_end]
     return {
-        'above': so2html(above, above_ann),
-        'left': so2html(left, left_ann),
-        'spans': { k: so2html(span, a) for k, a in annsets.items() },
-        'right': so2html(right, right_ann),
-        'below': so2html(below, below_ann),
+        'above': _visualize_context_simple(text, 0, line_start, 'above'),
+        'left': escape(text[line_start:span_start]),
+        'spans': { k: standoff_to_html(span, a, offset=span_start)
+                   for k, a in annsets.items() },
+        'right': escape(text[span_end:line_end]),
+        'below': _visualize_context_simple(text, line_end, len(text),
+                                           'below'),
     }
 
 
-def _add_highlight_annotations(text, annsets):
+def _add_highlight_annotations(text, annsets, deadline=None, max_spans=None,
+                               max_patterns=None):
+    """Return underline annotations for mentions of annotated strings in
+    text. Raise _BudgetExceeded if deadline (perf_counter() time) passes
+    or there would be more than max_spans annotations."""
     from .so2html import Standoff, FORMATTING_TYPE_TAG_MAP
     underline = [k for k, v in FORMATTING_TYPE_TAG_MAP.items() if v == 'u'][0]
     flattened = [a for anns in annsets.values() for a in anns]
     texts = [a.text for a in flattened if a.text]
+    if max_patterns is not None and len(set(texts)) > max_patterns:
+        texts = list(dict.fromkeys(texts))[:max_patterns]
     patterns = [ re.compile(r'\b'+re.escape(t)+r'\b', re.I) for t in texts ]
     spans = []
     for p in patterns:
+        if deadline is not None and time.perf_counter() > deadline:
+            raise _BudgetExceeded('time budget')
         for m in p.finditer(text):
             start, end = m.span()
             spans.append(Standoff(start, end, underline, 'u'))
+        if max_spans is not None and len(spans) > max_spans:
+            raise _BudgetExceeded('{}+ highlight spans'.format(len(spans)))
     return spans
 
 
-def _adjust_offsets(annsets, offset):
-    # TODO consider making copies instead of modifying annotations in place
-    for key, annset in annsets.items():
-        for a in annset:
-            a.adjust_offsets(offset)
-    return annsets
-
-
 def _tokenize(text, reverse=False):
     if not reverse:
         tokens = re.split(r'(\s+)', text)
@@ -115,6 +324,20 @@ def _tokenize(text, reverse=False):
     return [t for t in tokens if t]
 
 
+def _skip_space(text, start, end):
+    """Return index of first non-space character in text[start:end]."""
+    while start < end and text[start].isspace():
+        start += 1
+    return start
+
+
+def _skip_space_reverse(text, start, end):
+    """Return index after last non-space character in text[start:end]."""
+    while end > start and text[end-1].isspace():
+        end -= 1
+    return end
+
+
 def _split_text(text, start, end, line_width=None):
     """Split text into five parts with reference to (start, end) span: (above,
     left, span, right, below), where (left, span, right) are on the
@@ -127,9 +350,20 @@ def _split_text(text, start, end, line_width=None):
     span_text = text[start:end]
     span_width = _text_width(span_text)
 
-    # add words to left and right until line width would be exceeded
-    left_tokens = _tokenize(text[:start])
-    right_tokens = _tokenize(text[end:], reverse=True)
+    # add words to left and right until line width would be exceeded.
+    # Only the span line is tokenized: tokens before the whitespace
+    # containing the last newline (after the first newline) are
+    # discarded below in any case.
+    line_start = text.rfind('\n', 0, start) + 1
+    if line_start:
+        line_start = _skip_space(text, line_start, start)
+    line_end = text.find('\n', end)
+    if line_end != -1:
+        line_end = _skip_space_reverse(text, end, line_end)
+    else:
+        line_end = len(text)
+    left_tokens = _tokenize(text[line_start:start])
+    right_tokens = _tokenize(text[end:line_end], reverse=True)
 
     # trim candidate tokens to avoid including newlines in span
     def trim_tokens(tokens, filter_chars='\n'):
@@ -185,21 +419,14 @@ def _text_width(text, point_size=None, font_file=None):
         point_size = conf.get_font_size()
     if font_file is None:
         font_file = conf.get_font_file()
-    if font_file not in _text_width.cache:
-        font_path = os.path.join(app.root_path, 'static', 'fonts', font_file)
-        _text_width.cache[font_file] = TTFont(font_path)
-    ttfont = _text_width.cache[font_file]
-    # Following https://stackoverflow.com/a/48357457
-    cmap = ttfont['cmap']
-    tcmap = cmap.getcmap(3,1).cmap
-    glyphset = ttfont.getGlyphSet()
-    units_per_em = ttfont['head'].unitsPerEm
-    total = 0
-    for c in text:
-        if ord(c) in tcmap and tcmap[ord(c)] in glyphset:
-            total += glyphset[tcmap[ord(c)]].width
-        else:
-            total += glyphset['.notdef'].width
-    total_points = total * point_size / units_per_em
-    return total_points
+    font_metrics = _text_width.cache.get(font_file)
+    if font_metrics is None:
+        with _text_width.lock:
+            if font_file not in _text_width.cache:
+                font_path = os.path.join(app.root_path, 'static', 'fonts',
+                                         font_file)
+                _text_width.cache[font_file] = load_metrics(font_path)
+            font_metrics = _text_width.cache[font_file]
+    return font_metrics.text_width(text, point_size)
 _text_width.cache = {}
+_text_width.lock = threading.Lock()
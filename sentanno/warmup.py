@@ -0,0 +1,66 @@
+import os
+import gc
+import time
+import heapq
+
+from jinja2 import FileSystemBytecodeCache
+
+from . import metrics
+from .db import get_db
+
+
+def init_bytecode_cache(app):
+    """Cache compiled templates on disk, shared across processes."""
+    cache_dir = os.path.join(app.config['TEMPDIR'], 'jinja')
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        app.logger.warning('No template cache in {}: {}'.format(cache_dir, e))
+        return
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+
+
+def _recent_documents(db, count):
+    """Return (collection, document) for the count most recently
+    modified documents."""
+    mtimes = []
+    for collection in db.get_collections():
+        for document in db.get_documents(collection):
+            try:
+                stats = db.get_document_stats(collection, document)
+            except Exception:
+                continue
+            mtimes.append((max(s[1] for s in stats), collection, document))
+    return [(c, d) for m, c, d in heapq.nlargest(count, mtimes)]
+
+
+def warm_up(app):
+    """Load data that would otherwise be loaded on first use by each
+    worker, so that it can be shared by workers forked after this."""
+    start = time.time()
+    with app.app_context():
+        from .visualize import _text_width
+        _text_width('')    # loads font metrics
+
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+
+        # Also fills the collection listing cache
+        db = get_db()
+        documents = _recent_documents(db, app.config['WARMUP_DOCUMENTS'])
+        for collection, document in documents:
+            try:
+                db.cache_document(collection, document)
+            except Exception as e:
+                app.logger.warning('Warm-up failed for {}/{}: {}'.format(
+                    collection, document, e))
+
+    # Keep the loaded objects out of GC so that collections in workers
+    # don't touch (and copy) the shared pages.
+    gc.freeze()
+
+    elapsed = time.time() - start
+    metrics.set_gauge('sentanno_warmup_seconds', elapsed)
+    metrics.set_gauge('sentanno_warmup_documents', len(documents))
+    app.logger.info('Warm-up took {:.3f}s ({} documents)'.format(
+        elapsed, len(documents)))